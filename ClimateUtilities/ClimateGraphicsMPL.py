@@ -162,16 +162,17 @@ def plot(*curves):
     #     we need to extract just the first element.
     countAll = 0
     for c in curves:
+        X = c.X()   #Same abcissa for all the columns of this Curve
         if cMaster.switchXY:
             count = 0
             for data in c.Y():
-                plotList.append(plt.plot(data,c.X(),formatList[countAll])[0])
+                plotList.append(plt.plot(data,X,formatList[countAll])[0])
                 count += 1
                 countAll += 1
         else:
             count = 0
             for data in c.Y():
-                plotList.append(plt.plot(c.X(),data,formatList[countAll])[0])
+                plotList.append(plt.plot(X,data,formatList[countAll])[0])
                 count += 1
                 countAll += 1
                 
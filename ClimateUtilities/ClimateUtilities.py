@@ -2,6 +2,7 @@
 Dependencies
 ------------
 numpy, matplotlib
+scipy (optional, used for the LU factorizations in stiffIntegrator)
 
 Change Log
 ----------
@@ -17,15 +18,6 @@ ToDo
 
 *Implement show,hide for curves (in X() and Y())
 
-*Implement missing data coding .
-     self.setMissingDataCode(code) (char or numeric)
-     possibly translate, check and force consistency
-     
-*Possibly handle missing data for plotting using a
- fill() or interp() method to fill in missing data using
- the interpolation routine. The best way to handle
- missing data in computations is by using Masked Arrays
-
 *Make and import a PathFinder module, which the instructor
  will customize for the site.  This module will help the
  students find locations of datasets and chapter scripts.
@@ -37,7 +29,26 @@ ToDo
 '''
 
 import string
+import os
+import json
+import math
+import heapq
+import collections
+import glob
+import io
+import warnings
+import tempfile
+import concurrent.futures
+import gzip
+import bz2
+import lzma
 import numpy as np
+try:
+    import scipy.linalg
+    import scipy.sparse
+    import scipy.sparse.linalg
+except ImportError:
+    scipy = None #The stiff integrator then falls back on numpy
 import ClimateGraphicsMPL 
 
 #==============================================
@@ -48,9 +59,6 @@ import ClimateGraphicsMPL
 #
 #       Add keyword arguments for axes, etc,
 #
-#       How to handle missing data codes? Note that
-#         since lists are converted to Numeric arrays,
-#         text codes can't be used.
 #       Provide a method to set which data is X.
 #
 #       Add output option to put out a LaTeX formatted table
@@ -58,7 +66,33 @@ import ClimateGraphicsMPL
 #       Provide an easy way to add data column long-names
 
 class Curve:
-    def __init__(self):
+    '''
+    Container for a set of data columns, one of which is used as X.
+    
+    With Curve(columnStore=True) all numeric columns of the same
+    length are kept as the rows of one preallocated 2D array (the
+    column store), which grows as columns are added. X() and Y() then
+    return views of that array, instead of new copies, and Curve[id]
+    is a view of its row. Note that in this mode the data given to
+    addCurve or __setitem__ are copied into the store, as floats.
+    Replacing a column with __setitem__ copies the new column to new
+    memory, so arrays you got from the Curve before keep their values,
+    and the other columns stay where they are. Note that X(), Y() and
+    Curve[id] can then be changed in place, which changes the Curve,
+    and that arrays you got before no longer follow the Curve once the
+    store is moved to new memory (when it grows to take more columns,
+    or when Y() re-orders it). readTable and loadCurve can also
+    return Curves with a column store. Without a column store (the
+    default) X() and Y() return new copies of the data.
+    
+    The views returned by X() and Y() are cached, and are only recomputed
+    after addCurve or __setitem__, or when Xid has been changed.
+    
+    slice(xmin,xmax) and at(x) pick out rows by their X value, with
+    a binary search on X. appendRow and appendRows add rows at the end.
+    '''
+    
+    def __init__(self, columnStore=False):
         self.Xid = None     # id of data to be considered as X
         self.data = {}      # Dictionary of data columns
         self.label = {}     #Data column label dictionary
@@ -75,6 +109,14 @@ class Curve:
         self.YlogAxis = 0   # Use logarithmic axis for Y
         self.Xlabel = ''    #X axis label
         self.Ylabel = ''    #Y axis label
+        self._store = None  #Column store (one row per column), if used
+        self._slot = {}     #Row of the column store used by each id
+        self._nrows = 0     #Length of the columns in the store
+        self._cache = {}    #Cached results of X() and Y()
+        self._masks = {}    #Growable mask buffers of masked columns, for appendRows
+        self._retired = set() #Rows of the store left to replaced columns
+        if columnStore:
+            self._store = np.zeros((4,0))
         
     def addCurve(self, data, id = '', label = ''):
         ''' Install a new curve in the data set, optionally with a variable name and label
@@ -89,6 +131,8 @@ class Curve:
         #Transform data from list to a Numeric array here
         if type(data) == type([]):
             data = np.array(data)
+        if self._storable(data):
+            data = self._toStore(id,data)
         self.data[id] = data
         
         if self.Xid == None:
@@ -97,6 +141,7 @@ class Curve:
         
         self.label[id] = label
         self.scatter[id] = False
+        self._cache = {}
         #ToDo: Add checking for consistent lengths, type, etc. of what's being added
         
     def listVariables(self):
@@ -117,62 +162,443 @@ class Curve:
             data = np.array(data)
             
         if id in list(self.data.keys()):
+            if self._storable(data,id) and not (id in self._slot and len(self._slot) > 1):
+                data = self._toStore(id,data)
+            elif id in self._slot:
+                #The new column gets memory of its own, so that arrays which
+                #still refer to the old one (or a read-only store from
+                #loadCurve) are left alone. The old row of the store is
+                #not used again, and the column goes back into the store
+                #when the store is next re-ordered (see _pack).
+                self._retired.add(self._slot.pop(id))
+                if self._storable(data,id):
+                    data = self._toColumn(data)
             self.data[id] = data
+            self._cache = {}
         else:
             self.addCurve(data, id)
     
+    def appendRow(self,row):
+        ''' Appends one row to the Curve. row is a dictionary of values
+        for each column id, or a sequence of values in the order of
+        listVariables(). If the Curve has no columns yet, they are
+        created from the row (named v0, v1... for a sequence).
+        
+        Usage, to record the output of an integrator (with one column
+        for x, and one for each component of y):
+            c = Curve()
+            while ... :
+                x,y = m.next()
+                c.appendRow(np.append(x,y))
+        '''
+        
+        if type(row) == type({}):
+            rows = dict([(id,[row[id]]) for id in row])
+        else:
+            rows = [row]
+        self.appendRows(rows)
+        
+    def appendRows(self,rows):
+        ''' Appends several rows at once. rows is a dictionary of arrays
+        (one for each column id), or a 2D array-like with one row per
+        line, as in appendRow.
+        
+        The columns are kept in the column store, which is started if
+        the Curve doesn't use one yet (see Curve). The store is made
+        longer in geometrically growing steps, so that appending takes
+        constant time per row on average, and the columns stay views of
+        the store. Rows appended to Masked Array columns are not masked.
+        '''
+        
+        #Check everything before the Curve is changed
+        if type(rows) == type({}):
+            extra = [id for id in rows if not (id in self.idList)]
+            if (len(self.idList) > 0) and (len(extra) > 0):
+                print("Error: no column %s in the Curve, in appendRows"%extra[0])
+                return None
+            ids = self.idList if (len(self.idList) > 0) else list(rows.keys())
+            try:
+                block = [rows[id] for id in ids]
+            except KeyError as id:
+                print("Error: no data for column %s in appendRows"%id)
+                return None
+        else:
+            block = np.array(rows,ndmin=2).T
+            ids = self.idList if (len(self.idList) > 0) else ['']*len(block)
+        if not (len(block) == len(ids)):
+            print("Error: appendRows needs %d columns"%len(ids))
+            return None
+        try:
+            block = [np.atleast_1d(np.asarray(np.ma.getdata(values),dtype=float)) for values in block]
+        except (TypeError,ValueError):
+            print("Error: appendRows only works with numeric data")
+            return None
+        if not all([(np.ndim(values) == 1) and (len(values) == len(block[0])) for values in block]):
+            print("Error: appendRows needs one value for each column in each row")
+            return None
+        if self._store is None:
+            columns = [self.data[id] for id in self.idList]
+            ok = all([(np.ndim(data) == 1) and (len(data) == len(columns[0])) and
+                      (np.asarray(np.ma.getdata(data)).dtype.kind in 'biuf') for data in columns])
+        else:
+            ok = all([self._packable(id) for id in self.idList])
+        if not ok:
+            print("Error: appendRows only works with numeric columns of the same length")
+            return None
+        
+        for id in ids[len(self.idList):]:
+            self.addCurve(np.zeros(0),id)
+        if self._store is None:
+            self._store = np.zeros((max(4,len(self.idList)),0))
+            for id in self.idList:
+                self.data[id] = self._toStore(id,self.data[id])
+        if not all([id in self._slot for id in self.idList]):
+            self._pack()
+        
+        n = self._nrows+len(block[0])
+        if n > self._store.shape[1]:
+            store = np.zeros((self._store.shape[0],max(n,2*self._store.shape[1],16)))
+            store[:,:self._nrows] = self._store[:,:self._nrows]
+            self._store = store
+        for id,values in zip(self.idList,block):
+            self._store[self._slot[id],self._nrows:n] = np.ma.getdata(values)
+        for id in self.idList:
+            column = self._store[self._slot[id],:n]
+            if np.ma.isMaskedArray(self.data[id]):
+                #The masks grow in the same steps as the store
+                mask = self._masks.get(id)
+                if (mask is None) or (len(mask) < n):
+                    mask = np.zeros(self._store.shape[1],dtype=bool)
+                    mask[:self._nrows] = np.ma.getmaskarray(self.data[id])
+                    self._masks[id] = mask
+                mask[self._nrows:n] = False
+                column = np.ma.MaskedArray(column,mask=mask[:n],copy=False)
+            self.data[id] = column
+        self._nrows = n
+        self._cache = {}
+    
+    def _storable(self,data,id=None):
+        '''Checks if data can go into the column store '''
+        
+        if self._store is None:
+            return False
+        if not (np.ndim(data) == 1):
+            return False
+        if not (np.asarray(np.ma.getdata(data)).dtype.kind in 'biuf'):
+            return False
+        #The first column sets the length of the others
+        others = [slotId for slotId in self._slot if not (slotId == id)]
+        return (len(others) == 0) or (len(data) == self._nrows)
+    
+    def _toStore(self,id,data):
+        '''Copies data into the column store, and returns the stored column '''
+        
+        if len(self._slot) == 0 or (list(self._slot.keys()) == [id]):
+            #(Re)start the store with the length of this column
+            self._store = np.zeros((self._store.shape[0],len(data)))
+            self._nrows = len(data)
+            self._slot = {}
+            self._retired = set()
+        if id in self._slot:
+            slot = self._slot[id]
+        else:
+            slot = self._freeSlot()
+            self._slot[id] = slot
+        self._masks.pop(id,None)
+        self._store[slot,:self._nrows] = np.ma.getdata(data)
+        column = self._store[slot,:self._nrows]
+        if np.ma.isMaskedArray(data):
+            column = np.ma.MaskedArray(column,mask=np.ma.getmaskarray(data).copy(),copy=False)
+        return column
+        
+    def _toColumn(self,data):
+        '''Copies data into a new float array, outside of the column store '''
+        
+        column = np.array(np.ma.getdata(data),dtype=float)
+        if np.ma.isMaskedArray(data):
+            column = np.ma.MaskedArray(column,mask=np.ma.getmaskarray(data).copy(),copy=False)
+        return column
+        
+    def _packable(self,id):
+        '''Checks if column id is in the column store, or can be put there '''
+        
+        if id in self._slot:
+            return True
+        data = self.data[id]
+        return self._storable(data,id) and (len(data) == self._nrows)
+        
+    def _freeSlot(self):
+        '''Returns the first unused row of the column store, and
+        doubles the size of the store if there is none left '''
+        
+        used = set(self._slot.values()) | self._retired
+        for slot in range(self._store.shape[0]):
+            if not (slot in used):
+                return slot
+        store = np.zeros((2*self._store.shape[0],self._store.shape[1]))
+        store[:self._store.shape[0]] = self._store
+        self._setStore(store)
+        return len(used)
+    
+    def _setStore(self,store):
+        '''Installs a new array as the column store, and points
+        the stored columns to it '''
+        
+        self._store = store
+        for id in self._slot:
+            column = store[self._slot[id],:self._nrows]
+            if np.ma.isMaskedArray(self.data[id]):
+                column = np.ma.MaskedArray(column,mask=self.data[id].mask,copy=False)
+            self.data[id] = column
+        self._retired = set()
+        self._cache = {}
+        
+    def _adoptStore(self,block,ids):
+        '''Uses the rows of a 2D array as the column store, without copying.
+        ids gives the names of the (distinct) columns. '''
+        
+        self._store = None
+        for i,id in enumerate(ids):
+            self.addCurve(block[i],id)
+        self._store = block
+        self._nrows = block.shape[1]
+        self._slot = dict([(id,i) for i,id in enumerate(ids)])
+        self._retired = set()
+            
+    def _pack(self):
+        '''Re-orders the column store so that X comes first, followed
+        by the Y columns, in the order of idList. Y() can then return
+        a view of the store. '''
+        
+        ids = [self.Xid]+[id for id in self.idList if not (id == self.Xid)]
+        ids = [id for id in ids if self._packable(id)]
+        ids += [id for id in self._slot if not (id in ids)]
+        store = np.zeros((max(self._store.shape[0],len(ids)),self._store.shape[1]))
+        for i,id in enumerate(ids):
+            if id in self._slot:
+                store[i,:self._nrows] = self._store[self._slot[id],:self._nrows]
+            else:
+                #A column which was replaced (see __setitem__)
+                store[i,:self._nrows] = np.ma.getdata(self.data[id])
+            self._slot[id] = i
+        self._setStore(store)
+        
     def X(self):
         '''Method to return abcissa array for plotting.
         Use of cross section lets us get data from any indexed object
         However, since Masked variables and Masked Arrays yield
         their same types as cross sections, we have to check
         explicitly for a _data component.
+        
+        For a Curve with a column store this is a view of the store,
+        otherwise it is a new copy of the data.
         '''
         
+        key = ('X',self.Xid,len(self.idList))
+        if key in self._cache:
+            return self._cache[key]
+        
         temp = self.data[self.Xid][:]
         if hasattr(temp,'_data'):
             temp = temp._data[:]
             
-        return np.array(temp, dtype=np.float)
+        if not (self.Xid in self._slot):
+            return np.array(temp, dtype=float)
+        #Only cache views of the store, which follow changes of the data
+        x = np.asarray(temp, dtype=float)
+        self._cache[key] = x
+        return x
     
     def Y(self):
-        '''Method to return ordinate array for plotting '''
+        '''Method to return ordinate array for plotting.
+        For a Curve with a column store this is a view of the store.
+        '''
+        
+        key = ('Y',self.Xid,len(self.idList))
+        if key in self._cache:
+            return self._cache[key]
+        
+        ids = [id for id in self.idList if not (id == self.Xid)]
+        if (self._store is not None) and (len(ids) > 0) and \
+           (len(set(ids)) == len(ids)) and all([self._packable(id) for id in ids]):
+            slots = [self._slot.get(id) for id in ids]
+            if (None in slots) or not (slots == list(range(slots[0],slots[0]+len(slots)))):
+                self._pack()
+                slots = [self._slot[id] for id in ids]
+            y = self._store[slots[0]:slots[0]+len(slots),:self._nrows]
+            self._cache[key] = y
+            return y
         
         #Use of cross section lets us get data from any indexed object
         outArray = []
-        for id in self.idList:
-            if not (id == self.Xid):
-                column = self.data[id]
-                if hasattr(column,'_data'):
-                    outArray.append(column._data[:]) #Deals with masked arrays and variables
-                else:
-                    outArray.append(column[:])
+        for id in ids:
+            column = self.data[id]
+            if hasattr(column,'_data'):
+                outArray.append(column._data[:]) #Deals with masked arrays and variables
+            else:
+                outArray.append(column[:])
                     
-        return np.array(outArray, dtype=np.float)
+        return np.array(outArray, dtype=float)
 
-    def dump(self,fileName = 'out.txt'):
-        '''Dumps curve to a tab-delimited ascii file with column header '''
+    def dump(self,fileName = 'out.txt',format = 'text',compression = None,
+             missingCode = 'nan'):
+        '''Dumps curve to a tab-delimited ascii file with column header.
+        
+        Optional arguments:
+        format       'text' (the default), 'csv' (comma-delimited),
+                     'fixed' (fixed-width columns, padded with blanks),
+                     or 'binary' (the format of Curve.save)
+        compression  'gzip', 'bz2' or 'xz'. By default this is chosen
+                     from the file extension ('.gz', '.bz2' or '.xz');
+                     use '' to suppress compression.
+        missingCode  the text written for the masked entries of Masked
+                     Array columns, e.g. '-' (read them back with
+                     readTable(fileName,missingCodes=['-'])). The
+                     binary format keeps the masks themselves.
         
-        outfile = open(fileName,'w')
+        The data are formatted and written in blocks of _dumpBlockSize rows.
+        '''
+        
+        #Check the arguments before the file is opened (and emptied)
+        compression = _outputCompression(fileName,compression)
+        if compression is None:
+            return None
+        ids = self.idList
+        if format == 'text':
+            header = '\t'.join(ids)
+            formats = ['%e']*len(ids)
+            sep = '\t'
+        elif format == 'csv':
+            header = ','.join(ids)
+            formats = ['%e']*len(ids)
+            sep = ','
+        elif format == 'fixed':
+            widths = [max(15,len(id)+1) for id in ids]
+            header = ''.join([id.rjust(width) for id,width in zip(ids,widths)])
+            formats = ['%%%d.6e'%width for width in widths]
+            sep = ''
+        elif format == 'binary':
+            if compression == '':
+                return self.save(fileName)
+            if not self._checkLengths():
+                return None
+        else:
+            print("Error: unknown format %s"%format)
+            return None
+        
+        outfile = _openOutput(fileName,compression,binary=(format == 'binary'))
+        if format == 'binary':
+            self._writeBinary(outfile)
+            outfile.close()
+            return
         
         # Write out the data description if it is available.
         if not (self.description == None):
             if not self.description[-1] == '\n':
                 self.description += '\n' #Put in a newline if needed
             outfile.write(self.description)
-        header = ""
-        fmt = ""
+        outfile.write(header+'\n')
+        
+        #Format a whole block of rows with a single % operation
+        columns = [self._column(id) for id in ids]
+        masks = [np.ma.getmaskarray(self.data[id]) if np.ma.isMaskedArray(self.data[id])
+                 else None for id in ids]
+        fmt = sep.join(formats)
+        nrows = len(columns[0])
+        for i in range(0,nrows,_dumpBlockSize):
+            block = [column[i:i+_dumpBlockSize] for column in columns]
+            blockFmt = fmt
+            if any([(mask is not None) and mask[i:i+_dumpBlockSize].any() for mask in masks]):
+                #Columns with masked entries are formatted as text first
+                blockFmt = []
+                for j,mask in enumerate(masks):
+                    if (mask is None) or not mask[i:i+_dumpBlockSize].any():
+                        blockFmt.append(formats[j])
+                        continue
+                    code = missingCode
+                    if format == 'fixed':
+                        code = code.rjust(widths[j])
+                    block[j] = np.where(mask[i:i+_dumpBlockSize],code,
+                                        np.char.mod(formats[j],block[j]))
+                    blockFmt.append('%s')
+                blockFmt = sep.join(blockFmt)
+                block = np.array(block,dtype=object)
+            else:
+                block = np.array(block)
+            outfile.write(((blockFmt+'\n')*block.shape[1])%tuple(block.T.ravel().tolist()))
+        outfile.close()
+        
+    def _column(self,id):
+        '''Returns a column as an array (the data part, for masked arrays) '''
+        
+        column = self.data[id]
+        if hasattr(column,'_data'):
+            column = column._data
+        return np.asarray(column)
+
+    def save(self,fileName = 'out.cuc'):
+        '''Saves the curve to a binary file, which can be memory-mapped
+        by loadCurve. All columns have to have the same length.
+
+        The file starts with a short header (see _curveMagic), followed
+        by the column ids, labels, axis options etc as JSON text, and then
+        the data: one contiguous block of little-endian doubles with
+        one row per column, and the masks of Masked Array columns.
+        
+        The file is first written under a temporary name, which then
+        replaces fileName. A Curve from loadCurve(fileName) can thus
+        be saved back to the file it is mapped from.
+        '''
+
+        if not self._checkLengths():
+            return None
+        outfile,tempName = _openTemporary(fileName)
+        try:
+            self._writeBinary(outfile)
+            outfile.close()
+            os.replace(tempName,fileName)
+        except:
+            outfile.close()
+            os.remove(tempName)
+            raise
+        
+    def _checkLengths(self):
+        '''Checks that all columns have the same length, as needed by save '''
+        
+        lengths = set([len(self.data[id]) for id in self.idList])
+        if len(lengths) > 1:
+            print("Error: all columns must have the same length to save a Curve")
+            return False
+        return True
+        
+    def _writeBinary(self,outfile):
+        '''Writes the file contents for save to an open file object
+        (the lengths of the columns are checked by _checkLengths) '''
+
         ids = self.idList
-        for id in ids:
-            header += id+'\t'
-            fmt += '%e\t'
-        header = header[0:-1]+'\n'  # Replaces last tab with a newline.
-        fmt = fmt[0:-1] + '\n'
+        nrows = len(self.data[ids[0]]) if len(ids) > 0 else 0
+        maskIds = [id for id in ids if np.ma.isMaskedArray(self.data[id])]
+
+        meta = {'nrows':nrows, 'idList':ids, 'maskIds':maskIds,
+                'Xid':self.Xid,
+                'label':dict([(id,str(self.label[id])) for id in ids]),
+                'scatter':dict([(id,bool(self.scatter[id])) for id in ids]),
+                'NumCurves':self.NumCurves, 'description':self.description,
+                'PlotTitle':self.PlotTitle, 'Xlabel':self.Xlabel, 'Ylabel':self.Ylabel}
+        for option in _curveOptions:
+            meta[option] = int(getattr(self,option))
+        header = json.dumps(meta).encode('utf-8')
+        #Pad the header, so that the data are aligned in the file
+        nHeader = len(_curveMagic)+8+len(header)
+        header += b' '*(-nHeader % 64)
+
+        outfile.write(_curveMagic)
+        outfile.write(np.uint64(len(header)).astype('<u8').tobytes())
         outfile.write(header)
-        for i in range(len(self.data[ids[0]])):
-            out = tuple([(self.data[id])[i] for id in ids])
-            outfile.write(fmt%out)
-        outfile.close()
+        for id in ids:
+            outfile.write(np.ascontiguousarray(self._column(id),dtype='<f8').data)
+        for id in maskIds:
+            outfile.write(np.ascontiguousarray(np.ma.getmaskarray(self.data[id])).data)
 
     def extract(self, dataList):
         ''' Extracts a subset of the data and returns it as a new Curve.
@@ -184,9 +610,107 @@ class Curve:
         for dataName in dataList:
             c.addCurve(self[dataName],dataName)
         return c
-            
 
-def scan(buff,inHeader=None,delimiter = None):
+    def slice(self,xmin,xmax):
+        ''' Returns a new Curve with the rows for which xmin <= X <= xmax.
+        If X is increasing or decreasing (e.g. pressure in a sounding),
+        these rows are found by binary search, and the columns of the
+        new Curve are views of the columns of this one, not copies.
+        Otherwise the selected rows are copied, in their original order.
+        The labels and plot options are carried over.
+        '''
+        
+        kind,xs,order = self._xIndex()
+        if kind == 'decreasing':
+            n = len(xs)
+            rows = slice(n-np.searchsorted(xs,xmax,'right'),n-np.searchsorted(xs,xmin,'left'))
+        else:
+            rows = slice(np.searchsorted(xs,xmin,'left'),np.searchsorted(xs,xmax,'right'))
+        if kind == 'unsorted':
+            rows = np.sort(order[rows])
+        
+        c = Curve()
+        for id in self.idList:
+            c.addCurve(self.data[id][rows],id,self.label[id])
+            c.scatter[id] = self.scatter[id]
+        c.Xid = self.Xid
+        for option in ['description','PlotTitle','Xlabel','Ylabel']+_curveOptions:
+            setattr(c,option,getattr(self,option))
+        return c
+        
+    def at(self,x):
+        ''' Returns the row whose X value is closest to x, as a
+        dictionary of the values in each column. Like slice,
+        this uses a binary search on X. '''
+        
+        kind,xs,order = self._xIndex()
+        i = np.searchsorted(xs,x)
+        if i == len(xs) or (i > 0 and (x-xs[i-1]) <= (xs[i]-x)):
+            i = i-1
+        if kind == 'decreasing':
+            i = len(xs)-1-i
+        elif kind == 'unsorted':
+            i = order[i]
+        return dict([(id,self.data[id][i]) for id in self.idList])
+        
+    def _xIndex(self):
+        ''' Returns the index used by slice and at: the kind of X
+        ('increasing', 'decreasing' or 'unsorted'), the X values in
+        increasing order, and, for unsorted X, the permutation that
+        sorts X. For a Curve with a column store, the index is cached
+        like the results of X(), so it is only recomputed when columns
+        are changed with addCurve or __setitem__, or Xid is reset (after
+        changing X in place, assign it again with c[c.Xid] = ...).
+        Otherwise X() is a copy, and the index is made at each call.
+        '''
+        
+        key = ('index',self.Xid,len(self.idList))
+        if key in self._cache:
+            return self._cache[key]
+        
+        x = self.X()
+        dx = np.diff(x)
+        if np.all(dx >= 0):
+            index = ('increasing',x,None)
+        elif np.all(dx <= 0):
+            index = ('decreasing',x[::-1],None)
+        else:
+            order = np.argsort(x,kind='stable')
+            index = ('unsorted',x[order],order)
+        if self.Xid in self._slot:
+            self._cache[key] = index
+        return index
+
+    def fill(self,n=4):
+        ''' Fills in the masked (missing) entries of the Masked Array
+        columns, by interpolating in X with interp (n is the number of
+        neighbors used, as in interp). Columns that have been filled
+        become ordinary arrays, so that X() and Y() return complete
+        data. Entries in rows where X itself is missing stay masked.
+        '''
+
+        x = self.X()
+        xMissing = np.ma.getmaskarray(self.data[self.Xid])
+        for id in self.idList:
+            column = self.data[id]
+            if (id == self.Xid) or not np.ma.isMaskedArray(column):
+                continue
+            good = ~np.ma.getmaskarray(column) & ~xMissing
+            missing = np.ma.getmaskarray(column) & ~xMissing
+            if not (missing.any() and good.any()):
+                continue
+            order = np.argsort(x[good],kind='stable')
+            f = interp(x[good][order],column._data[good][order],n)
+            values = np.array(column._data,dtype=float)
+            values[missing] = f(x[missing])
+            stillMissing = np.ma.getmaskarray(column) & xMissing
+            if stillMissing.any():
+                self[id] = np.ma.MaskedArray(values,mask=stillMissing)
+            else:
+                self[id] = values
+
+
+def scan(buff,inHeader=None,delimiter = None,missingCodes = None):
     ''' Scans a list of lines, locates data lines
     and size, splits of column headers and
     splits off general information text.
@@ -196,16 +720,29 @@ def scan(buff,inHeader=None,delimiter = None):
     uses any whitespace character (including tabs) as
     column delimiters. Commas are not whitespace characters,
     and so need to be specified if they are used.
+    
+    missingCodes is an optional list of the codes used for missing
+    data, e.g. ['-','NA',-999.]. If it is given, the data columns
+    are Masked Arrays, in which the missing data (and empty or
+    unreadable entries) are masked, and set to NaN.
+
+    Returns a dictionary of data columns (numpy arrays), and
+    the header.
     '''
     #ToDo:
-    #       *Implement missing data coding (with default '-').
-    #            self.setMissingDataCode(code) (char or numeric)
-    #            possibly translate, check and force consistency
     #       *Replace optional positional arguments with keyword arguments
     
-    if inHeader == None:
-        inHeader = []
+    varlist,header = _scanColumns(buff,inHeader,delimiter,missingCodes)
+    vardict = {}
+    for name in header:
+        vardict[name] = varlist[header.index(name)]
         
+    return vardict,header #header is returned so we can keep cols in orig order
+
+def _scanColumns(buff,inHeader=None,delimiter=None,missingCodes=None):
+    ''' Does the work for scan, but returns the columns as a list
+    (or 2D array) in the order of the header '''
+    
     #First delete blank lines
     buff = clean(buff)
     
@@ -214,11 +751,26 @@ def scan(buff,inHeader=None,delimiter = None):
     
     # Found number of items. Now read in the data
     #Read in the first line. Is it a header?
+    header,istart = _findHeader(buff[startDataLine],inHeader,delimiter)
+    
+    varlist = _parseColumns(buff[(startDataLine+istart):endDataLine],len(header),
+                            delimiter,missingCodes)
+    return varlist,header
+
+def _findHeader(firstLine,inHeader=None,delimiter=None):
+    ''' Decides whether the first line of a data block is a column
+    header. Returns the header and the number of header lines (0 or 1)
+    that precede the numbers.
+    '''
+    
+    if inHeader == None:
+        inHeader = []
+        
     header = []
     if delimiter == None:
-        line = buff[startDataLine].split()
+        line = firstLine.split()
     else:
-        line = buff[startDataLine].split(delimiter)
+        line = firstLine.split(delimiter)
         
     try:
         float(line[0])
@@ -234,9 +786,15 @@ def scan(buff,inHeader=None,delimiter = None):
     if len(inHeader) == len(line):
         header = inHeader
         
-    # Read in the rest of the lines
-    varlist = [[] for i in range(len(header))]
-    for line in buff[(startDataLine+istart):endDataLine]:
+    return header,istart
+
+def _scanRows(lines,ncols,delimiter=None):
+    ''' Converts data lines into a list of ncols columns (lists of
+    floats). Lines that can't be parsed are printed and skipped.
+    '''
+    
+    varlist = [[] for i in range(ncols)]
+    for line in lines:
         if delimiter == None:
             items = line.split()
         else:
@@ -246,61 +804,710 @@ def scan(buff,inHeader=None,delimiter = None):
                 varlist[i].append(float(items[i]))
         except:
             print(items)
-    vardict = {}
-    for name in header:
-        vardict[name] = varlist[header.index(name)]
-        
-    return vardict,header #header is returned so we can keep cols in orig order
+            
+    return varlist
+
+def _parseColumns(lines,ncols,delimiter=None,missingCodes=None):
+    ''' Converts data lines into ncols data columns. Normally all the
+    numbers are converted by numpy in one go, and the columns are
+    returned as the rows of an (ncols,nrows) array, so that each
+    column is contiguous in memory. If any line can't be parsed that
+    way, we fall back on _scanRows, which skips bad lines one by one.
+    
+    With missingCodes, the result is a Masked Array (see _parseMissing).
+    '''
+
+    if not (missingCodes == None):
+        return _parseMissing(lines,ncols,delimiter,missingCodes)
+    if len(lines) == 0:
+        return np.zeros((ncols,0))
+    try:
+        block = np.loadtxt(lines,delimiter=delimiter,usecols=range(ncols),
+                           comments=None,ndmin=2)
+    except ValueError:
+        return [np.array(column) for column in _scanRows(lines,ncols,delimiter)]
+
+    return np.ascontiguousarray(block.T)
+
+def _parseMissing(lines,ncols,delimiter,missingCodes):
+    ''' Converts data lines into an (ncols,nrows) Masked Array. Entries
+    that match one of the missingCodes (as text, or as numbers), or that
+    are empty or can't be converted, are masked and set to NaN.
+    The masks are made with array operations on all the entries at once.
+    '''
+    
+    if not (type(missingCodes) in [type([]),type(())]):
+        missingCodes = [missingCodes]
+    nrows = len(lines)
+    items = None
+    if delimiter == None:
+        items = ' '.join(lines).split()
+    if (items == None) or not (len(items) == nrows*ncols):
+        #Pad or cut each line to ncols items
+        items = []
+        for line in lines:
+            if delimiter == None:
+                row = line.split()
+            else:
+                row = [item.strip() for item in line.split(delimiter)]
+            items += (row+['']*ncols)[:ncols]
+    items = np.array(items,dtype=str).reshape((nrows,ncols))
+    
+    mask = np.isin(items,[str(code) for code in missingCodes]+[''])
+    items[mask] = 'nan'
+    try:
+        values = items.astype(float)
+    except ValueError:
+        values = np.array([_toFloat(item) for item in items.ravel()]).reshape((nrows,ncols))
+        mask |= np.isnan(values) & ~(np.char.lower(items) == 'nan')
+    numericCodes = [code for code in missingCodes if not (type(code) == type(''))]
+    if len(numericCodes) > 0:
+        mask |= np.isin(values,numericCodes)
+    values[mask] = np.nan
+    
+    return np.ma.MaskedArray(np.ascontiguousarray(values.T),mask=np.ascontiguousarray(mask.T))
+
+def _toFloat(item):
+    '''float(item), or NaN if item isn't a number '''
+    
+    try:
+        return float(item)
+    except ValueError:
+        return np.nan
 
 def clean(buff):
     '''Eliminates blank lines '''
-    
+
     buff = [line.strip() for line in buff]
-    while(1):
-        try:
-            buff.remove('')
-        except:
-            break
-        
-    return buff
+    return [line for line in buff if len(line) > 0]
 
 def findData(buff):
-    runStarts = []
-    for i in range(len(buff)-1):
-        dn = abs(len(buff[i].split())-len(buff[i+1].split()))
-        if not dn==0:
-            runStarts.append(i+1)
-    runStarts.append(len(buff))
+    ''' Locates the data in a list of lines, as the longest
+    run of lines with the same number of items. Returns the
+    index of the first data line, and one past the last one.
+    '''
+
+    #Number of items on each line, with a single split per line
+    counts = np.fromiter(map(len,map(str.split,buff)),dtype=int,count=len(buff))
+    return _findRun(counts)
+
+def _findRun(counts):
+    ''' Does the work of findData, given the number of items on each line '''
+    
+    runStarts = np.append(np.flatnonzero(np.diff(counts))+1,len(counts))
     #Find index of run with max length
-    nmax = -1
-    for i in range(len(runStarts)-1):
-        n = runStarts[i+1]-runStarts[i]
-        if n > nmax:
-            nmax = n
-            imax = runStarts[i]
+    runLengths = np.diff(runStarts)
     #Deal with case where entire file is one run
-    if nmax == -1:
-        nmax = len(buff)
-        imax = 0
-        
-    return imax,imax+nmax
+    if len(runLengths) == 0:
+        return 0,len(counts)
+    imax = np.argmax(runLengths)
+
+    return int(runStarts[imax]),int(runStarts[imax]+runLengths[imax])
 
-def readTable(filename,inHeader = None,delimiter = None):
+def _countItems(data):
+    ''' Counts the whitespace-separated items on each line of the
+    bytes data (ASCII text with newlines), as str.split would, with
+    array operations on blocks of _scanBlockSize bytes. Returns the
+    counts, and the offsets of the newlines in data. '''
+    
+    #Without other control characters, whitespace is just the bytes <= 32,
+    #which is quicker to find than with the _whitespace table
+    simple = len(data.translate(None,_plainBytes)) == 0
+    counts = []
+    newlines = []
+    carry = 0        #Items so far on the line that runs on into the next block
+    lastSpace = True #Whether the block before ended with whitespace
+    for i0 in range(0,len(data),_scanBlockSize):
+        block = np.frombuffer(data,dtype=np.uint8,offset=i0,
+                              count=min(_scanBlockSize,len(data)-i0))
+        if simple:
+            space = block <= 32
+        else:
+            space = _whitespace[block]
+        #Items start at a non-whitespace byte after whitespace
+        starts = ~space
+        starts[1:] &= space[:-1]
+        starts[0] &= lastSpace
+        lastSpace = space[-1]
+        starts = np.flatnonzero(starts)
+        ends = np.flatnonzero(block == 10)
+        if len(ends) == 0:
+            carry += len(starts)
+            continue
+        k = np.searchsorted(starts,ends) #Items before each newline
+        lineCounts = np.diff(k,prepend=0)
+        lineCounts[0] += carry
+        carry = len(starts)-k[-1]
+        counts.append(lineCounts)
+        newlines.append(ends+i0)
+    counts.append([carry]) #The last line (empty if data ends with a newline)
+    return np.concatenate(counts),np.concatenate(newlines+[np.zeros(0,dtype=np.intp)])
+
+def _scanBytes(data,inHeader=None,delimiter=None,missingCodes=None):
+    ''' Does the work of _scanColumns for the whole contents of a
+    file, as bytes, without splitting it into lines in Python. The data
+    block is located from the number of items on each line (see
+    _countItems), and handed to numpy as one piece of text. Returns
+    None if this can't be done (non-ASCII text, old Mac line ends, or
+    no data), and the caller then uses _scanColumns. '''
+    
+    if not data.isascii():
+        return None
+    hasCR = b'\r' in data
+    if hasCR and not (data.count(b'\r') == data.count(b'\r\n')):
+        return None
+    counts,newlines = _countItems(data)
+    lines = np.flatnonzero(counts) #The non-blank lines, as clean leaves them
+    if len(lines) == 0:
+        return None
+    startDataLine,endDataLine = _findRun(counts[lines])
+    lineStarts = np.append(0,newlines+1)
+    lineEnds = np.append(newlines,len(data))
+    def text(i,j):
+        #Lines i to j (of the original numbering), as a string
+        lines = data[lineStarts[i]:lineEnds[j]].decode('ascii')
+        return lines.replace('\r\n','\n') if hasCR else lines
+    
+    first = lines[startDataLine]
+    header,istart = _findHeader(text(first,first).strip(),inHeader,delimiter)
+    if startDataLine+istart == endDataLine:
+        return np.zeros((len(header),0)),header
+    i,j = lines[startDataLine+istart],lines[endDataLine-1]
+    block = text(i,j)
+    nrows,ncols = endDataLine-startDataLine-istart,len(header)
+    if (missingCodes == None) and (delimiter == None):
+        #All the lines have ncols items, so if numpy reads all the
+        #text as numbers, there is one for each item
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('error') #Older numpy only warns
+                values = np.fromstring(block,sep=' ')
+            if len(values) == nrows*ncols:
+                return np.ascontiguousarray(values.reshape((nrows,ncols)).T),header
+        except (ValueError,DeprecationWarning):
+            pass
+    if (missingCodes == None) and ((delimiter == None) or (j-i+1 == nrows)):
+        #numpy skips blank lines, unless there is a delimiter
+        try:
+            values = np.loadtxt(io.StringIO(block),delimiter=delimiter,usecols=range(ncols),
+                                comments=None,ndmin=2)
+            return np.ascontiguousarray(values.T),header
+        except ValueError:
+            pass
+    #Bad lines, or missing data: parse the lines one by one
+    return _parseColumns(clean(block.split('\n')),ncols,delimiter,missingCodes),header
+
+def readTable(filename,inHeader = None,delimiter = None,missingCodes = None,fill = False,
+              columnStore = False):
     ''' Function to read space or tab-delimited file into a curve object
     The input header is a list of names of the variables in each
     columns, which can be input optionally, mainly to deal with
     the case in which this information is not in the file being read
+    
+    missingCodes is an optional list of codes for missing data (see scan);
+    the columns are then Masked Arrays. With fill=True the missing data
+    are then filled in by interpolation (see Curve.fill).
+    
+    Files compressed with gzip, bz2 or xz are read directly (the format
+    is recognized from the first bytes of the file, not the name).
+    
+    With columnStore=True the Curve keeps its columns in a column
+    store (see Curve), which the parsed data are put into without
+    copying them.
     '''
     
-    f = open(filename)
-    buff = f.readlines()
-    data,header = scan(buff,inHeader,delimiter)
-    c = Curve()
-    for key in header:
-        c.addCurve(data[key],key)
+    varlist,header = _readColumns(filename,inHeader,delimiter,missingCodes)
+    c = _makeCurve(varlist,header,columnStore)
+    if fill:
+        c.fill()
         
     return c
+
+def _readColumns(filename,inHeader=None,delimiter=None,missingCodes=None):
+    ''' Reads a table file into a list (or 2D array) of data columns,
+    and the header. A compressed file is never held in memory as a
+    whole: it is decompressed twice, as a stream, once to locate the
+    data and once to convert it, a chunk of lines at a time, into a
+    preallocated array. '''
+    
+    compression = _compression(filename)
+    if compression == None:
+        f = open(filename,'rb')
+        result = _scanBytes(f.read(),inHeader,delimiter,missingCodes)
+        f.close()
+        if not (result is None):
+            return result
+        f = open(filename)
+        buff = f.readlines()
+        f.close()
+        return _scanColumns(buff,inHeader,delimiter,missingCodes)
+    
+    #First pass: find the data block, from the number of items on each line
+    f = _openInput(filename,compression)
+    startDataLine,endDataLine = _findDataStream(f)
+    f.close()
+    if endDataLine == 0:
+        raise IndexError('no data in %s'%filename)
+    
+    #Second pass: skip to the data block and convert it
+    f = _openInput(filename,compression)
+    lines = _cleanStream(f)
+    for i in range(startDataLine+1):
+        firstLine = next(lines)
+    header,istart = _findHeader(firstLine,inHeader,delimiter)
+    ncols = len(header)
+    nrows = endDataLine-startDataLine-istart
+    values = np.zeros((ncols,nrows))
+    mask = None
+    if not (missingCodes == None):
+        mask = np.zeros((ncols,nrows),dtype=bool)
+    rows = [] if istart == 1 else [firstLine]
+    nread = len(rows) #Lines read so far
+    n = np.zeros(ncols,dtype=int) #Values filled in so far, in each column
+    while True:
+        for line in lines:
+            if nread == nrows:
+                break
+            rows.append(line)
+            nread += 1
+            if len(rows) >= _readChunkSize or nread == nrows:
+                break
+        if len(rows) == 0:
+            break
+        block = _parseColumns(rows,ncols,delimiter,missingCodes)
+        if type(block) == type([]):
+            #Bad lines were skipped, and the columns can differ in
+            #length (as for an uncompressed file)
+            for i,column in enumerate(block):
+                values[i,n[i]:n[i]+len(column)] = column
+                n[i] += len(column)
+        elif np.all(n == n[0]):
+            m = block.shape[1]
+            values[:,n[0]:n[0]+m] = np.ma.getdata(block)
+            if not (mask is None):
+                mask[:,n[0]:n[0]+m] = np.ma.getmaskarray(block)
+            n += m
+        else:
+            for i in range(ncols):
+                values[i,n[i]:n[i]+block.shape[1]] = block[i]
+            n += block.shape[1]
+        rows = []
+    f.close()
+    
+    if not np.all(n == n[0]):
+        #Uneven columns, returned as a list as in _parseColumns
+        return [values[i,:n[i]].copy() for i in range(ncols)],header
+    if n[0] < nrows:
+        values = values[:,:n[0]]
+        mask = None if mask is None else mask[:,:n[0]]
+    if not (mask is None):
+        return np.ma.MaskedArray(values,mask=mask,copy=False),header
+    return values,header
+
+def _cleanStream(f):
+    '''Generator version of clean, for a file that is read line by line '''
+    
+    for line in f:
+        line = line.strip()
+        if len(line) > 0:
+            yield line
+
+def _findDataStream(f):
+    ''' Streaming version of findData, which reads the lines from the
+    open file f, without keeping them. Gives the same result as
+    findData(clean(f.readlines())), i.e. the index of the first data
+    line and one past the last one, counting non-blank lines only.
+    '''
     
+    n = 0
+    runStart = 0
+    lastCount = None
+    imax,nmax = 0,-1
+    for line in _cleanStream(f):
+        count = len(line.split())
+        if not (count == lastCount) and not (lastCount == None):
+            #A run ends here. As in findData, the first run doesn't count
+            if runStart > 0 and n-runStart > nmax:
+                imax,nmax = runStart,n-runStart
+            runStart = n
+        lastCount = count
+        n += 1
+    #Deal with case where entire file is one run
+    if runStart == 0:
+        return 0,n
+    if n-runStart > nmax:
+        imax,nmax = runStart,n-runStart
+    return imax,imax+nmax
+
+def sniffDelimiter(buff):
+    ''' Guesses the column delimiter of a list of (cleaned) data lines.
+    Returns ',' or ';' if every line contains the same, nonzero number
+    of them, and None (i.e. any whitespace) otherwise.
+    '''
+    
+    for delimiter in [',',';']:
+        counts = set([line.count(delimiter) for line in buff])
+        if len(counts) == 1 and counts.pop() > 0:
+            return delimiter
+    return None
+
+def readTableChunks(filename,chunkSize=100000,inHeader=None,delimiter=None,nPrefix=1000,
+                    missingCodes=None,columnStore=False):
+    ''' Generator version of readTable, for files too big to be held
+    in memory. The file is read line by line, and a new Curve object
+    holding the next chunkSize rows of the table is yielded whenever
+    that many rows have been collected (the last Curve can be shorter).
+    
+    The location of the data, the header, and (if it isn't given)
+    the delimiter are worked out from the first nPrefix lines of the
+    file, the same way scan does it for a whole file. If the block
+    found there doesn't start with a number (e.g. when a description
+    at the top of the file is longer than nPrefix lines), the prefix
+    is doubled until it does, or the file ends. The data block
+    then continues until the first non-blank line with a different
+    number of items. missingCodes and columnStore work as in readTable.
+    
+    Usage:
+    ------
+        for c in readTableChunks('sounding.txt',chunkSize=10000):
+            print(c.X().max())
+    '''
+    
+    f = _openInput(filename)
+    try:
+        #Read in a short prefix, and locate the data in it. If the block
+        #found isn't numbers, read in a longer prefix and try again
+        prefix = []
+        while True:
+            for line in f:
+                prefix.append(line)
+                if len(prefix) >= nPrefix:
+                    break
+            atEnd = (len(prefix) < nPrefix)
+            buff = clean(prefix)
+            if len(buff) == 0:
+                return
+            startDataLine,endDataLine = findData(buff)
+            sep = delimiter
+            if sep == None:
+                sep = sniffDelimiter(buff[startDataLine:endDataLine])
+            header,istart = _findHeader(buff[startDataLine],inHeader,sep)
+            if startDataLine+istart < endDataLine:
+                if _isDataLine(buff[startDataLine+istart],sep,missingCodes):
+                    break
+            if atEnd:
+                print("Error: no data found in %s"%filename)
+                return
+            nPrefix = 2*nPrefix
+        delimiter = sep
+        nItems = len(buff[startDataLine].split())
+        
+        #The rows in the prefix, then the rest of the file, if the data
+        #run extends to the end of the prefix
+        rows = buff[(startDataLine+istart):endDataLine]
+        inData = (endDataLine == len(buff))
+        while True:
+            while len(rows) >= chunkSize:
+                yield _makeCurve(_parseColumns(rows[:chunkSize],len(header),delimiter,missingCodes),
+                                 header,columnStore)
+                rows = rows[chunkSize:]
+            if not inData:
+                break
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                if not (len(line.split()) == nItems):
+                    inData = False
+                    break
+                rows.append(line)
+                if len(rows) >= chunkSize:
+                    break
+            else:
+                inData = False
+        if len(rows) > 0:
+            yield _makeCurve(_parseColumns(rows,len(header),delimiter,missingCodes),header,columnStore)
+    finally:
+        f.close()
+
+def _isDataLine(line,delimiter=None,missingCodes=None):
+    ''' Checks whether a line starts with a number (or a missing code),
+    the same way _findHeader tells data from a header '''
+    
+    item = line.split(delimiter)[0]
+    if not (missingCodes == None):
+        if not (type(missingCodes) in [type([]),type(())]):
+            missingCodes = [missingCodes]
+        if item.strip() in [str(code) for code in missingCodes]:
+            return True
+    try:
+        float(item)
+    except ValueError:
+        return False
+    return True
+
+def _makeCurve(varlist,header,columnStore=False):
+    ''' Puts a list (or 2D array) of data columns into a new Curve
+    object, optionally with a column store, which then uses the
+    2D array without copying it '''
+    
+    c = Curve(columnStore=columnStore)
+    if columnStore and isinstance(varlist,np.ndarray) and (len(set(header)) == len(header)):
+        c._adoptStore(np.ma.getdata(varlist),header)
+        if np.ma.isMaskedArray(varlist):
+            for i,id in enumerate(header):
+                c.data[id] = np.ma.MaskedArray(c.data[id],mask=np.ma.getmaskarray(varlist)[i],copy=False)
+    else:
+        for name in header:
+            c.addCurve(varlist[header.index(name)],name)
+    return c
+
+def readTables(paths,workers=None,inHeader=None,delimiter=None,missingCodes=None,
+               concatenate=False,columnStore=False):
+    ''' Reads many tables in parallel, with a pool of worker processes.
+    paths is a list of file names, or a glob pattern like 'soundings/*.txt'.
+    workers is the number of processes (the default is one per CPU;
+    with workers=1 the files are read in this process).
+    The other arguments are passed on to readTable.
+
+    Returns (curves,errors): curves is a dictionary of Curve objects,
+    with the file names as keys, and errors a dictionary with an error
+    message for each file that couldn't be read. A bad file doesn't
+    stop the others from being read.
+
+    With concatenate=True, curves is instead a single Curve, holding
+    the rows of all the files with the same header as the first one,
+    plus a column 'file' with the index of the file each row comes
+    from. The files are listed in the description of the Curve.
+
+    The workers send back the data as arrays, not as Curve objects.
+    Note that on Windows and macOS the calling script has to protect
+    its main code with "if __name__ == '__main__':".
+    '''
+
+    if type(paths) == type(''):
+        paths = sorted(glob.glob(paths))
+    args = [(path,inHeader,delimiter,missingCodes) for path in paths]
+    if workers == 1:
+        results = [_readTableArrays(arg) for arg in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_readTableArrays,args,chunksize=max(1,len(args)//64)))
+
+    curves = {}
+    errors = {}
+    for path,(varlist,header,error) in zip(paths,results):
+        if error == None:
+            curves[path] = _makeCurve(varlist,header,columnStore)
+        else:
+            errors[path] = error
+    if not concatenate:
+        return curves,errors
+
+    #Stack the tables that match the first one
+    files = []
+    blocks = []
+    for path in curves:
+        c = curves[path]
+        if len(files) == 0:
+            header = c.listVariables()
+        if not (c.listVariables() == header):
+            errors[path] = 'Header %s differs from %s'%(c.listVariables(),header)
+            continue
+        if len(set([len(c[id]) for id in header])) > 1:
+            errors[path] = 'Columns of different lengths'
+            continue
+        block = np.ma.array([c[id] for id in header]+[np.zeros(len(c[header[0]]))+len(files)])
+        files.append(path)
+        blocks.append(block)
+    if len(files) == 0:
+        return Curve(),errors
+    c = _makeCurve(np.ma.concatenate(blocks,axis=1),header+['file'],columnStore)
+    c.description = '\n'.join(['file %d: %s'%(i,path) for i,path in enumerate(files)])
+    return c,errors
+
+def _readTableArrays(args):
+    ''' Worker for readTables: reads one table, and returns its columns
+    (as a 2D array, or a list of 1D arrays if they differ in length),
+    the header, and an error message or None '''
+
+    path,inHeader,delimiter,missingCodes = args
+    try:
+        varlist,header = _readColumns(path,inHeader,delimiter,missingCodes)
+        if not isinstance(varlist,np.ndarray):
+            varlist = [column if np.ma.isMaskedArray(column) else np.asarray(column,dtype=float)
+                       for column in varlist]
+    except Exception as error:
+        return None,None,'%s: %s'%(type(error).__name__,error)
+    return varlist,header,None
+
+#Marks the start of a file written by Curve.save
+_curveMagic = b'CUCURVE1'
+#Axis options of a Curve, stored as integers by Curve.save
+_curveOptions = ['switchXY','reverseX','reverseY','XlogAxis','YlogAxis']
+#Number of rows formatted at once by Curve.dump
+_dumpBlockSize = 65536
+#Number of lines converted at once when reading a compressed table
+_readChunkSize = 65536
+#Number of bytes of a table file looked at at once by _countItems
+_scanBlockSize = 1<<24
+#The bytes str.split takes as whitespace, in ASCII text
+_whitespace = np.zeros(256,dtype=bool)
+_whitespace[[9,10,11,12,13,28,29,30,31,32]] = True
+#The bytes of text without unusual control characters
+_plainBytes = bytes(range(9,14))+bytes(range(32,256))
+
+#Compressed file formats, with their file extensions and the
+#bytes at the start of the file
+_compressors = {'gzip':gzip, 'bz2':bz2, 'xz':lzma}
+_compressionExtensions = {'.gz':'gzip', '.bz2':'bz2', '.xz':'xz'}
+_compressionMagic = [(b'\x1f\x8b','gzip'), (b'BZh','bz2'), (b'\xfd7zXZ\x00','xz')]
+
+def _compression(fileName):
+    '''Returns the compression format of a file ('gzip', 'bz2'
+    or 'xz'), judging from its first bytes, or None '''
+    
+    f = open(fileName,'rb')
+    start = f.read(6)
+    f.close()
+    for magic,compression in _compressionMagic:
+        if start.startswith(magic):
+            return compression
+    return None
+
+def _openInput(fileName,compression=None):
+    '''Opens a (possibly compressed) text file for reading. The
+    compressed formats are decompressed as the file is read. '''
+    
+    if compression == None:
+        compression = _compression(fileName)
+    if compression == None:
+        return open(fileName)
+    return _compressors[compression].open(fileName,'rt')
+
+def _outputCompression(fileName,compression=None):
+    '''Returns the compression to use for an output file ('' for none),
+    by default chosen from the file extension, or None if it is unknown '''
+    
+    if compression == None:
+        compression = _compressionExtensions.get(os.path.splitext(fileName)[1],'')
+    if not (compression == '' or compression in _compressors):
+        print("Error: unknown compression %s"%compression)
+        return None
+    return compression
+
+def _openOutput(fileName,compression=None,binary=False):
+    '''Opens a file for writing, compressed if requested. By default
+    the compression is chosen from the file extension. '''
+    
+    compression = _outputCompression(fileName,compression)
+    if compression is None:
+        return None
+    mode = 'wb' if binary else 'w'
+    if compression == '':
+        return open(fileName,mode)
+    if not binary:
+        mode = 'wt'
+    if compression == 'gzip':
+        #The gzip default (level 9) is very slow, for little gain
+        return gzip.open(fileName,mode,compresslevel=6)
+    return _compressors[compression].open(fileName,mode)
+
+def _openTemporary(fileName):
+    '''Opens a new temporary file for binary writing, in the directory
+    of fileName and with the permissions fileName has (or would get).
+    Returns the file object and the name of the temporary file. '''
+    
+    fd,tempName = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)),
+                                   prefix='.'+os.path.basename(fileName)+'.')
+    if os.path.exists(fileName):
+        permissions = os.stat(fileName).st_mode & 0o7777
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        permissions = 0o666 & ~umask
+    os.chmod(tempName,permissions)
+    return os.fdopen(fd,'wb'),tempName
+
+def loadCurve(fileName,mode = 'r',columnStore = False):
+    ''' Loads a Curve written by Curve.save. Only the header is read
+    here: the data columns are np.memmap views of the file, so
+    the data are only read from disk when they are used. This also
+    lets several processes share one big Curve without copying it.
+
+    mode is the np.memmap mode: 'r' (read-only, the default),
+    'c' (copy-on-write: changes stay in memory), or 'r+'
+    (changes are written back to the file).
+    
+    Compressed files (e.g. from Curve.dump(...,format='binary'))
+    can't be memory-mapped, and are read into memory instead.
+    
+    With columnStore=True the mapped block is used as the column
+    store of the Curve (see Curve), so that X() and Y() are views of
+    the file. With mode 'r' these views are then read-only.
+    '''
+
+    compression = _compression(fileName)
+    if compression == None:
+        f = open(fileName,'rb')
+    else:
+        f = _compressors[compression].open(fileName,'rb')
+    magic = f.read(len(_curveMagic))
+    if not (magic == _curveMagic):
+        f.close()
+        print("Error: %s was not written by Curve.save"%fileName)
+        return None
+    nHeader = int(np.frombuffer(f.read(8),dtype='<u8')[0])
+    meta = json.loads(f.read(nHeader).decode('utf-8'))
+
+    offset = len(_curveMagic)+8+nHeader
+    ids = meta['idList']
+    maskIds = meta['maskIds']
+    shape = (len(ids),meta['nrows'])
+    if (shape[0]*shape[1] == 0) or not (compression == None):
+        block = np.zeros(shape)
+        masks = np.zeros((len(maskIds),shape[1]),dtype=bool)
+        _readInto(f,block)
+        _readInto(f,masks)
+    else:
+        block = np.memmap(fileName,dtype='<f8',mode=mode,offset=offset,shape=shape)
+        masks = None
+        if len(maskIds) > 0:
+            masks = np.memmap(fileName,dtype=bool,mode=mode,offset=offset+block.nbytes,
+                              shape=(len(maskIds),shape[1]))
+    f.close()
+
+    c = Curve(columnStore=columnStore)
+    if columnStore and (len(set(ids)) == len(ids)):
+        c._adoptStore(block,ids)
+    else:
+        for i,id in enumerate(ids):
+            c.addCurve(block[i],id)
+    for id in ids:
+        c.label[id] = meta['label'][id]
+        c.scatter[id] = meta['scatter'][id]
+    for i,id in enumerate(maskIds):
+        c.data[id] = np.ma.MaskedArray(c.data[id],mask=masks[i],copy=False)
+    c.Xid = meta['Xid']
+    c.NumCurves = meta['NumCurves']
+    for option in ['description','PlotTitle','Xlabel','Ylabel']+_curveOptions:
+        setattr(c,option,meta[option])
+
+    return c
+
+def _readInto(f,a):
+    '''Fills the array a with bytes read from the file object f '''
+    
+    if a.size == 0:
+        return
+    buff = memoryview(a).cast('B')
+    n = 0
+    while n < len(buff):
+        nRead = f.readinto(buff[n:])
+        if not nRead:
+            break
+        n += nRead
+
 #==============================================
 #---Section 2: Math utilities-------------------
 #==============================================
@@ -319,14 +1526,23 @@ def polint(xa,ya,x):
     It's used in Romberg extrapolation, but could be useful
     for polynomial OLR fits and so forth as well. Also
     needs online documentation
+    
+    x can also be an array of points, at which the polynomial
+    is then evaluated all at once (see _neville).
     '''
     n = len(xa)
     if not (len(xa) == len(ya)):
             print("Input x and y arrays must be same length")
             return "Error"
+    if np.ndim(x) > 0:
+        x = np.asarray(x,dtype=float)
+        xa = np.asarray(xa,dtype=float)
+        ya = np.asarray(ya,dtype=float)
+        y = _neville(xa[:,np.newaxis],np.repeat(ya[:,np.newaxis],x.size,axis=1),x.ravel())
+        return y.reshape(x.shape)
         #Set up auxiliary arrays
-    c = np.zeros(n, dtype=np.float)
-    d = np.zeros(n, dtype=np.float)
+    c = np.zeros(n, dtype=float)
+    d = np.zeros(n, dtype=float)
     c[:] = ya[:]
     d[:] = ya[:]
     #Find closest table entry
@@ -356,6 +1572,33 @@ def polint(xa,ya,x):
     
     return y
 
+def _neville(xa,ya,x):
+    ''' The polint algorithm, for many interpolation problems at once:
+    column j of the (n,m) arrays xa and ya is the table used for the
+    point x[j]. xa can also be an (n,1) array, if all the points use
+    the same table. Each step of the Neville tableau is done for all
+    the points together, in the same order as in polint, so that the
+    results agree with polint to round-off.
+    '''
+    
+    n = len(ya)
+    c = np.array(ya,dtype=float)
+    d = np.array(ya,dtype=float)
+    cols = np.arange(len(x))
+    #Find closest table entry (the first one, in case of ties)
+    ns = np.argmin(abs(xa-x),axis=0)*np.ones(len(x),dtype=int)
+    y = ya[ns,cols]
+    for m in range(1,n):
+        ho = xa[:n-m]-x
+        hp = xa[m:]-x
+        w = c[1:n-m+1]-d[:n-m]
+        c[:n-m] = ho*w/(ho-hp)
+        d[:n-m] = hp*w/(ho-hp)
+        up = (2*ns < (n-m))
+        ns = np.where(up,ns,ns-1)
+        y += np.where(up,c[ns,cols],d[ns,cols])
+    return y
+
 class interp:
     '''
     Class for doing polynomial interpolation
@@ -379,25 +1622,205 @@ class interp:
         
                     f = interp(xa,ya,8)
         will use the 8 nearest neighbors (if they are available)
+        
+        x can also be an array, e.g. f(np.linspace(0.,1.,100000)).
+        The result is then an array of the same shape, computed
+        for all the points at once.
+        
+        The optional keyword argument kind chooses the method:
+            'neville'  (the default) evaluates the polynomial through
+                       the neighbors anew for each x, using polint
+            'poly'     gives the same piecewise polynomials, but
+                       their coefficients are computed once, when f
+                       is created
+            'cubic'    natural cubic spline
+            'monotone' monotone cubic (PCHIP) interpolation, which
+                       doesn't overshoot between the table entries
+        With the last three, each evaluation is just a binary search
+        and a Horner evaluation, which pays when f is used many times.
+        For 'cubic' and 'monotone', n is not used; outside the table
+        these extrapolate with the cubic of the first or last interval;
+        a table with a single entry gives the constant ya[0].
     
     '''
     
-    def __init__(self, xa, ya, n=4):
+    def __init__(self, xa, ya, n=4, kind='neville'):
         self.xa = np.array(xa)
         self.ya = np.array(ya)
         self.n = n
+        self.kind = kind
+        if kind == 'poly':
+            self._polyCoefs()
+        elif kind == 'cubic':
+            self._splineCoefs(self._cubicSlopes)
+        elif kind == 'monotone':
+            self._splineCoefs(self._monotoneSlopes)
+        elif not (kind == 'neville'):
+            print("Error: unknown kind of interpolation %s"%kind)
         
     def __call__(self,x):
+        if np.ndim(x) > 0:
+            x = np.asarray(x,dtype=float)
         #Find the closes index to x
         if self.xa[0] < self.xa[-1]:
             i = np.searchsorted(self.xa,x)
         else:
             i = np.searchsorted(-self.xa,-x)
+        if self.kind in ['poly','cubic','monotone']:
+            return self._horner(x,i)
+        if np.ndim(x) > 0:
+            return self._interpArray(x,i)
             
         i1 = max(i-self.n,0)
         i2 = min(i+self.n,len(self.xa))
         
         return polint(self.xa[i1:i2],self.ya[i1:i2],x)
+    
+    def _interpArray(self,x,i):
+        '''Does the work of __call__ for an array of points x, with
+        the indices i found by searchsorted '''
+        
+        shape = x.shape
+        x = x.ravel()
+        i = i.ravel()
+        i1 = np.maximum(i-self.n,0)
+        i2 = np.minimum(i+self.n,len(self.xa))
+        y = np.zeros(len(x))
+        #Points near the ends of the table have shorter stencils,
+        #so group the points by stencil length
+        for length in np.unique(i2-i1):
+            points = np.flatnonzero((i2-i1) == length)
+            rows = i1[points]+np.arange(length)[:,np.newaxis]
+            y[points] = _neville(self.xa[rows],self.ya[rows],x[points])
+        return y.reshape(shape)
+    
+    #The precomputed kinds store a polynomial for each interval between
+    #the table entries, in Newton form: coefficients c and nodes z with
+    #    p(x) = c[0] + (x-z[0])*(c[1] + (x-z[1])*(c[2] + ...))
+    #which is evaluated like a Horner scheme. Row i is used for the x with
+    #searchsorted index i (so rows 0 and len(xa) are for extrapolation).
+    
+    def _horner(self,x,i):
+        '''Evaluates the precomputed polynomials at x '''
+        
+        if np.ndim(x) == 0:
+            #Python floats are much faster than numpy scalars here
+            coefs = self._coefs[i].tolist()
+            nodes = self._nodes[i].tolist()
+            x = float(x)
+        else:
+            coefs = np.moveaxis(self._coefs[i],-1,0)
+            nodes = np.moveaxis(self._nodes[i],-1,0)
+        y = coefs[-1]
+        for k in range(len(coefs)-2,-1,-1):
+            y = y*(x-nodes[k])+coefs[k]
+        return y
+        
+    def _polyCoefs(self):
+        '''Computes the polynomials used by the 'neville' kind, i.e.
+        the polynomial through the same neighbors as in __call__, by
+        divided differences '''
+        
+        xa = np.asarray(self.xa,dtype=float)
+        ya = np.asarray(self.ya,dtype=float)
+        i = np.arange(len(xa)+1)
+        i1 = np.maximum(i-self.n,0)
+        i2 = np.minimum(i+self.n,len(xa))
+        self._coefs = np.zeros((len(i),np.max(i2-i1)))
+        self._nodes = np.zeros((len(i),np.max(i2-i1)))
+        for length in np.unique(i2-i1):
+            intervals = np.flatnonzero((i2-i1) == length)
+            rows = i1[intervals][:,np.newaxis]+np.arange(length)
+            xs = xa[rows]
+            coefs = ya[rows]
+            for k in range(1,length):
+                coefs[:,k:] = (coefs[:,k:]-coefs[:,k-1:-1])/(xs[:,k:]-xs[:,:-k])
+            #Shorter stencils get zeros for the highest coefficients
+            self._coefs[intervals,:length] = coefs
+            self._nodes[intervals,:length] = xs
+            
+    def _splineCoefs(self,slopes):
+        '''Computes the cubics of a spline, given a function that
+        returns its slopes at the table entries '''
+        
+        xa = np.asarray(self.xa,dtype=float)
+        ya = np.asarray(self.ya,dtype=float)
+        if len(xa) < 2:
+            #A single point: constant interpolation
+            self._coefs = np.array([[ya[0],0.,0.,0.]]*2)
+            self._nodes = np.zeros((2,4))+xa[0]
+            return
+        if xa[0] > xa[-1]:
+            xa = xa[::-1]
+            ya = ya[::-1]
+        h = np.diff(xa)
+        delta = np.diff(ya)/h
+        m = slopes(h,delta)
+        #Hermite cubic on each interval, in powers of x-xa[k]
+        #(i.e. Newton form with all nodes at xa[k])
+        coefs = np.array([ya[:-1],m[:-1],(3*delta-2*m[:-1]-m[1:])/h,
+                          (m[:-1]+m[1:]-2*delta)/h**2]).T
+        #Extrapolate with the first and last cubics
+        coefs = np.concatenate([coefs[:1],coefs,coefs[-1:]])
+        nodes = np.concatenate([xa[:1],xa[:-1],xa[-2:-1]])
+        if not (self.xa[0] < self.xa[-1]):
+            #Searchsorted indices then run the other way
+            coefs = coefs[::-1]
+            nodes = nodes[::-1]
+        self._coefs = np.ascontiguousarray(coefs)
+        self._nodes = np.repeat(nodes[:,np.newaxis],4,axis=1)
+        
+    def _cubicSlopes(self,h,delta):
+        '''Slopes of the natural cubic spline (zero second derivative
+        at the ends), from the tridiagonal equations for them '''
+        
+        n = len(h)+1
+        if n < 3:
+            return np.array([delta[0],delta[0]])
+        #Equations a*m[k-1] + b*m[k] + c*m[k+1] = r
+        a = np.concatenate([[0.],h[1:],[1.]])
+        b = np.concatenate([[2.],2*(h[:-1]+h[1:]),[2.]])
+        c = np.concatenate([[1.],h[:-1],[0.]])
+        r = np.concatenate([[3*delta[0]],3*(h[1:]*delta[:-1]+h[:-1]*delta[1:]),[3*delta[-1]]])
+        #Solve by forward elimination and back substitution
+        for k in range(1,n):
+            w = a[k]/b[k-1]
+            b[k] -= w*c[k-1]
+            r[k] -= w*r[k-1]
+        m = np.zeros(n)
+        m[-1] = r[-1]/b[-1]
+        for k in range(n-2,-1,-1):
+            m[k] = (r[k]-c[k]*m[k+1])/b[k]
+        return m
+        
+    def _monotoneSlopes(self,h,delta):
+        '''Slopes of the monotone (PCHIP) cubic of Fritsch and Carlson:
+        weighted harmonic means of the neighboring secants, and zero at
+        local extrema '''
+        
+        if len(h) < 2:
+            return np.array([delta[0],delta[0]])
+        m = np.zeros(len(h)+1)
+        w1 = 2*h[1:]+h[:-1]
+        w2 = h[1:]+2*h[:-1]
+        same = (delta[:-1]*delta[1:] > 0)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            mean = (w1+w2)/(w1/delta[:-1]+w2/delta[1:])
+        m[1:-1] = np.where(same,mean,0.)
+        m[0] = self._endSlope(h[0],h[1],delta[0],delta[1])
+        m[-1] = self._endSlope(h[-1],h[-2],delta[-1],delta[-2])
+        return m
+        
+    def _endSlope(self,h0,h1,delta0,delta1):
+        '''One-sided three-point slope at an end of the table, limited
+        so that the monotone interpolant stays shape preserving '''
+        
+        m = ((2*h0+h1)*delta0-h0*delta1)/(h0+h1)
+        if not (np.sign(m) == np.sign(delta0)):
+            m = 0.
+        elif not (np.sign(delta0) == np.sign(delta1)) and (abs(m) > abs(3*delta0)):
+            m = 3*delta0
+        return m
 
 
 class BetterTrap:
@@ -407,26 +1830,54 @@ class BetterTrap:
     Before developing a general quadrature class, we'll
     implement a class which efficiently carries out trapezoidal rule
     integration with iterative refinement
+    
+    If f accepts an array of x values (as e.g. phys.B does), all the
+    points of a refinement level are computed in a single call of f.
+    vectorized=True or False says whether f does; with the default
+    None this is found out by calling f on the two endpoints at once.
     '''
     
-    def __init__(self,f,params,interval,nstart):
+    def __init__(self,f,params,interval,nstart,vectorized=None):
         self.f = f
         self.n = nstart
         self.interval = interval
         self.params = params
+        self.vectorized = vectorized
+        self.nEval = 0  #Number of evaluations of f
         self.integral = self.dumbTrap(nstart)
         
     def dumbTrap(self,n):
         a = self.interval[0]
         b = self.interval[1]
         dx = (b-a)/n
-        sum = dx*(self.f(a,self.params)+self.f(b,self.params))/2.
+        ends = self._endpoints(a,b)
+        self.nEval += n+1
+        if self.vectorized:
+            x = a+np.arange(1,n)*dx
+            return dx*(ends[0]+ends[1])/2.+np.sum(self.f(x,self.params))*dx
+        sum = dx*(ends[0]+ends[1])/2.
         for i in range(1,n):
             x = a+i*dx
             sum = sum + self.f(x,self.params)*dx
             
         return sum
     
+    def _endpoints(self,a,b):
+        '''Returns f at a and b. Unless we've been told whether f takes
+        arrays, this tries calling it with both points at once. '''
+        
+        if not (self.vectorized == False):
+            try:
+                ends = self.f(np.array([a,b],dtype=float),self.params)
+                if np.shape(ends) == (2,):
+                    self.vectorized = True
+                    return ends
+            except Exception:
+                if self.vectorized:
+                    raise
+            self.vectorized = False
+        return self.f(a,self.params),self.f(b,self.params)
+    
     def refine(self):
         ''' Compute the sum of f(x) at the
         midpoints between the existing intervals.
@@ -440,31 +1891,409 @@ class BetterTrap:
         b = self.interval[1]
         dx = (b-a)/self.n
         
-        #Remember: n is the number of subintervals, not the number of endpoints.
-        #Therefore we have one midpoint per subinterval. Keeping that
-        #in mind helps us get the range of i right in the following loop
+        #Remember: n is the number of subintervals, not the number of endpoints.
+        #Therefore we have one midpoint per subinterval. Keeping that
+        #in mind helps us get the range of i right in the following loop
+        
+        self.nEval += self.n
+        if self.vectorized:
+            x = a+(np.arange(self.n)+.5)*dx
+            sum = np.sum(self.f(x,self.params))*(dx/2.)
+        else:
+            for i in range(self.n):
+                sum = sum + self.f(a+(i+.5)*dx,self.params)*(dx/2.)
+            
+        #The old trapezoidal sum was multiplied by the old dx. To get its
+        #correct contribution to the refined sum, we must multiply it by .5,
+        #because the new dx is half the old dx
+        self.integral = .5*self.integral + sum
+        
+        #Update the number of intervals
+        self.n = 2*self.n
+
+class romberg:
+    ''' Here I define a class called
+    romberg, which assists in carrying out evaluation of
+    integrals using romberg extrapolation. It assumes polint has
+    been imported
+    
+    If the integrand accepts arrays of x, each refinement evaluates
+    all its new points in one call (see BetterTrap). The optional
+    argument vectorized=True/False tells romberg whether it does;
+    by default this is detected on the first evaluation.
+    
+    The method batch computes many integrals (over different
+    intervals, or with different params) together.
+    '''
+    
+    def __init__(self,f,nstart=4,vectorized=None,cacheSize=0):
+        self.nstart = nstart
+        self.vectorized = vectorized
+        self.trap = None
+        #Saved states of the last cacheSize integrations (see __call__)
+        self.cacheSize = cacheSize
+        self.cache = collections.OrderedDict()
+        
+        #-------------------------------------------------
+        #This snippit of code allows the user to leave the parameter argument
+        #out of the definition of f if it isn't needed
+        self.fin = f
+        
+        #Find the number of arguments of f and append a
+        #parameter argument if there isn't any.
+        nargs = f.__code__.co_argcount
+        if nargs == 2:
+            self.f = f
+        elif nargs ==1:
+            def f1(x,param):
+                return self.fin(x)
+            self.f = f1
+        else:
+            name = f.__name__
+            print('Error: %s has wrong number of arguments'%name)
+        #-----------------------------------------------------
+        
+        #We keep lists of all our results, for doing Romberg extrapolation.
+        #These are re-initialized after each call
+        self.nList = []
+        self.integralList = []
+        self.errorList = []  #Change of the extrapolated value at each refinement
+        self.valueList = []  #Extrapolated value at each refinement
+        self.tableau = []    #Latest row of the Richardson tableau
+        self.error = None    #Error estimate of the last result
+        self.nEval = 0       #Number of evaluations of f used for it
+        
+    def refine(self):
+        self.trap.refine()
+        self.integralList.append(self.trap.integral)
+        self.nList.append(self.trap.n)
+        oldval = self.tableau[-1]
+        newval = self._extrapolate()
+        self.errorList.append(abs(newval-oldval))
+        self.valueList.append(newval)
+        return newval
+    
+    def _extrapolate(self):
+        '''Adds the latest trapezoid sum to the Richardson tableau, and
+        returns the extrapolated value. This gives the same result as
+        extrapolating all the sums to dx = 0 with polint, since n
+        doubles at each refinement, but each level only costs O(k).
+        '''
+        
+        row = [self.integralList[-1]]
+        for j in range(1,len(self.tableau)+1):
+            row.append(row[j-1]+(row[j-1]-self.tableau[j-1])/(4.**j-1.))
+        self.tableau = row
+        return row[-1]
+    
+    def __call__(self,interval,params=None,tolerance=1.e-6,fullOutput=False,scale=1.):
+        ''' Use a __call__ method to return the result. The
+        __call__ method takes the interval of integration
+        as its mandatory first argument,takes an optional
+        parameter argument as its second argument, and
+        an optional keyword argument specifying the accuracy
+        desired.
+        
+        The interval can be infinite at one or both ends, e.g.
+        [0.,np.inf], if the integrand decays there. The integral is
+        then done in a new variable t, which maps the interval onto
+        a finite one (see _mapInfinite). scale should be about the
+        distance over which the integrand decays, e.g. k*T/h
+        for the Planck function of frequency.
+        
+        With fullOutput=True, the result is returned as a tuple
+        (value, error, nEval), where error is the change of the
+        extrapolated value at the last refinement and nEval the number
+        of evaluations of the integrand. These are also kept as
+        the attributes error and nEval, and the error at each
+        refinement in errorList.
+        
+        If romberg was created with cacheSize > 0, the state of the
+        integrations (trapezoid sums and Richardson tableau) for the
+        last cacheSize different intervals and params is kept. A new
+        call with the same interval and params, but a smaller
+        tolerance, then continues refining where the last one stopped,
+        and a call with a larger tolerance returns the value the
+        refinements gave then, without evaluating f at all. nEval
+        then counts all the evaluations made for these interval and
+        params. params are compared by value if they are numbers,
+        tuples, strings or numpy arrays, and otherwise by identity:
+        don't change the attributes of a params object between calls
+        while using the cache.
+        **ToDo: Introduce trick to allow parameter argument of
+        integrand to be optional, as in Integrator.  Also, make
+        tolerance into a keyword argument
+        '''
+        
+        key = self._cacheKey(interval,params,scale)
+        f,interval = _mapInfinite(self.f,interval,scale)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self._restore(self.cache[key])
+            #The first refinement that met the tolerance, if there was one
+            #(as when starting anew, at least two refinements are needed)
+            for i in range(1,len(self.errorList)):
+                if self.errorList[i] <= tolerance:
+                    return self._result(self.valueList[i],self.errorList[i],fullOutput)
+            newval = self.valueList[-1]
+        else:
+            self.nList = []
+            self.integralList = []
+            self.errorList = []
+            self.valueList = []
+            #Make a trapezoidal rule integrator
+            self.trap = BetterTrap(f,params,interval,self.nstart,self.vectorized)
+            self.nList.append(self.nstart)
+            self.integralList.append(self.trap.integral)
+            self.tableau = [self.trap.integral]
+            #
+            #Refine initial evaluation until 
+            newval = self.refine()
+        oldval,newval = newval,self.refine()
+        while abs(oldval-newval)>tolerance:
+            oldval,newval = newval,self.refine()
+        
+        if not (key == None):
+            self.cache[key] = self._save()
+            if len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+        return self._result(newval,self.errorList[-1],fullOutput)
+    
+    def batch(self,intervals,params=None,tolerance=1.e-6,fullOutput=False,scale=1.):
+        ''' Computes many integrals of f at once: intervals is an (m,2)
+        array of intervals, and/or params an array (or list) with the m
+        parameter values (e.g. surface temperatures); a single interval
+        or params value is used for all the integrals. (To use the same
+        list for all the integrals, put it in a Dummy object.) The integrand has to accept
+        arrays: it is called as f(x,p), where x is an (k,n) array with
+        the points for k of the integrals, and p the matching params
+        as a (k,1) array (k rows of params, if it has more dimensions),
+        so that x*p broadcasts.
+        
+        All the integrals are refined together, with one call of f per
+        refinement, and each integral stops being refined when it
+        meets the tolerance (a number, or an array of m numbers), in
+        the same way as in __call__. Intervals can be infinite at one
+        or both ends, with the same change of variables and scale as
+        in __call__. Returns an array of m values, or with
+        fullOutput=True, the tuple (values, errors, nEval) of arrays.
+        '''
+        
+        intervals = np.asarray(intervals,dtype=float)
+        if type(params) in [type([]),type(())]:
+            params = np.asarray(params)
+        batchParams = isinstance(params,np.ndarray) and (params.ndim > 0)
+        m = len(params) if batchParams else len(np.atleast_2d(intervals))
+        a = np.broadcast_to(intervals[...,0],(m,))
+        b = np.broadcast_to(intervals[...,1],(m,))
+        if batchParams and (params.ndim == 1):
+            params = params[:,np.newaxis]
+        tolerance = np.broadcast_to(tolerance,(m,))
+        #Infinite intervals are mapped to finite ones row by row
+        g,(a,b) = _mapInfinite(self.f,[a,b],scale)
+        def f(x,rows):
+            return g(x,params[rows] if batchParams else params,rows)
+        
+        #Trapezoid sums with nstart intervals
+        n = self.nstart
+        dx = (b-a)/n
+        fx = f(a[:,np.newaxis]+np.arange(n+1)*dx[:,np.newaxis],np.arange(m))
+        fx = np.broadcast_to(fx,(m,n+1))
+        tableau = [dx*(fx[:,0]+fx[:,-1])/2.+np.sum(fx[:,1:-1],axis=1)*dx]
+        values = tableau[0].copy()
+        errors = np.zeros(m)
+        nEval = np.zeros(m,dtype=int)+n+1
+        
+        active = np.arange(m)
+        level = 0
+        while len(active) > 0:
+            #Refine the integrals that haven't converged yet
+            dx = (b[active]-a[active])/n
+            x = a[active,np.newaxis]+(np.arange(n)+.5)*dx[:,np.newaxis]
+            sums = np.sum(np.broadcast_to(f(x,active),x.shape),axis=1)*(dx/2.)
+            row = [.5*tableau[0][active]+sums]
+            for j in range(1,len(tableau)+1):
+                row.append(row[j-1]+(row[j-1]-tableau[j-1][active])/(4.**j-1.))
+            for j in range(len(row)):
+                if j == len(tableau):
+                    tableau.append(np.zeros(m))
+                tableau[j][active] = row[j]
+            errors[active] = abs(row[-1]-values[active])
+            values[active] = row[-1]
+            nEval[active] += n
+            n = 2*n
+            level += 1
+            if level >= 2:
+                active = active[errors[active] > tolerance[active]]
+        
+        if fullOutput:
+            return values,errors,nEval
+        return values
+    
+    def _result(self,value,error,fullOutput):
+        '''Sets the error and nEval attributes, and returns the result '''
+        
+        self.error = error
+        self.nEval = self.trap.nEval
+        if fullOutput:
+            return value,self.error,self.nEval
+        return value
+    
+    def _cacheKey(self,interval,params,scale=1.):
+        '''Returns the key of the cache for an integration, or None
+        if it shouldn't be cached '''
+        
+        if self.cacheSize <= 0:
+            return None
+        if isinstance(params,np.ndarray):
+            params = (params.shape,params.dtype.str,params.tobytes())
+        key = (float(interval[0]),float(interval[1]),float(scale),params)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+    
+    def _save(self):
+        '''Returns the state of the current integration '''
+        
+        state = Dummy()
+        state.trap = self.trap
+        state.lists = (self.nList,self.integralList,self.errorList,self.valueList,self.tableau)
+        return state
+    
+    def _restore(self,state):
+        '''Continues an integration saved by _save '''
         
-        for i in range(self.n):
-            sum = sum + self.f(a+(i+.5)*dx,self.params)*(dx/2.)
-            
-        #The old trapezoidal sum was multiplied by the old dx. To get its
-        #correct contribution to the refined sum, we must multiply it by .5,
-        #because the new dx is half the old dx
-        self.integral = .5*self.integral + sum
+        self.trap = state.trap
+        self.nList,self.integralList,self.errorList,self.valueList,self.tableau = state.lists
         
-        #Update the number of intervals
-        self.n = 2*self.n
 
-class romberg:
-    ''' Here I define a class called
-    romberg, which assists in carrying out evaluation of
-    integrals using romberg extrapolation. It assumes polint has
-    been imported
+def _mapInfinite(f,interval,scale=1.):
+    ''' Turns an integral over an infinite interval into one over
+    a finite interval, by a change of variables:
+        [a,inf):    x = a + scale*t/(1-t),        0 <= t <= 1
+        (-inf,b]:   x = b - scale*t/(1-t),        0 <= t <= 1
+        (-inf,inf): x = scale*t/(1-t**2),        -1 <= t <= 1
+    scale should be about the distance over which f decays.
+    Returns the integrand g(t,params) (including dx/dt) and the
+    interval of t. The integrand is taken to be zero at the
+    infinite ends (t = 1 or -1), so f has to decay there.
+    A finite interval is returned unchanged, with f.
+    
+    The ends of the interval can also be arrays, for several
+    integrals at once (as in romberg.batch). Each interval is then
+    mapped as above, or left alone if it is finite, and the arrays
+    of the ends of t are returned. g is called as g(t,params,rows),
+    where rows picks the integrals for the rows of the 2D array t.
     '''
     
-    def __init__(self,f,nstart=4):
-        self.nstart = nstart
-        self.trap = None
+    a,b = np.asarray(interval[0],dtype=float),np.asarray(interval[1],dtype=float)
+    single = (np.ndim(a) == 0) and (np.ndim(b) == 0)
+    mapped = np.isinf(a) | np.isinf(b)
+    if single and not mapped:
+        return f,interval
+    flip = (a > b) & mapped
+    sign = np.where(flip,-1.,1.)
+    a,b = np.where(flip,b,a),np.where(flip,a,b)
+    lowInf,highInf = np.isinf(a),np.isinf(b)
+    both = lowInf & highInf
+    xa,xb = np.where(lowInf,0.,a),np.where(highInf,0.,b) #Finite ends
+    a = np.where(mapped,np.where(both,-1.,0.),a)
+    b = np.where(mapped,1.,b)
+    
+    def g(t,params,rows=Ellipsis):
+        if single:
+            row = lambda v: v
+        else:
+            row = lambda v: v[rows][:,np.newaxis]
+        if not np.any(row(mapped)):
+            return f(t,params)
+        inside = (~row(mapped)) | (abs(t) < 1.)
+        if np.ndim(t) == 0 and not inside:
+            return 0.
+        u = np.where(row(mapped) & inside,t,0.)
+        x = np.where(row(both),scale*u/(1.-u*u),
+                     np.where(row(highInf),row(xa)+scale*u/(1.-u),
+                              np.where(row(lowInf),row(xb)-scale*u/(1.-u),t)))
+        dxdt = np.where(row(both),scale*(1.+u*u)/(1.-u*u)**2,
+                        np.where(row(mapped),scale/(1.-u)**2,1.))
+        if np.ndim(t) == 0:
+            return f(x[()],params)*dxdt[()]*sign[()]
+        fx = np.broadcast_to(f(x,params),x.shape)
+        return np.where(inside,fx*dxdt,0.)*row(sign)
+    if single:
+        return g,[float(a),float(b)]
+    return g,[a,b]
+
+#Nodes (non-negative half, outermost first) and weights of the
+#Gauss-Kronrod rules, from QUADPACK (qk15 and qk21). The Gauss nodes
+#are the odd-numbered Kronrod nodes.
+_kronrodNodes = {
+    15:[0.991455371120812639206854697526329, 0.949107912342758524526189684047851,
+        0.864864423359769072789712788640926, 0.741531185599394439863864773280788,
+        0.586087235467691130294144845693013, 0.405845151377397166906606412076961,
+        0.207784955007898467600689403773245, 0.000000000000000000000000000000000],
+    21:[0.995657163025808080735527280689003, 0.973906528517171720077964012084452,
+        0.930157491355708226001207180059508, 0.865063366688984510732096688423493,
+        0.780817726586416897063717578345042, 0.679409568299024406234327365114874,
+        0.562757134668604683339000099272694, 0.433395394129247190799265943165784,
+        0.294392862701460198131126603103866, 0.148874338981631210884826001129720,
+        0.000000000000000000000000000000000]}
+_kronrodWeights = {
+    15:[0.022935322010529224963732008058970, 0.063092092629978553290700663189204,
+        0.104790010322250183839876322541518, 0.140653259715525918745189590510238,
+        0.169004726639267902826583426598550, 0.190350578064785409913256402421014,
+        0.204432940075298892414161999234649, 0.209482141084727828012999174891714],
+    21:[0.011694638867371874278064396062192, 0.032558162307964727478818972459390,
+        0.054755896574351996031381300244580, 0.075039674810919952767043140916190,
+        0.093125454583697605535065465083366, 0.109387158802297641899210590325805,
+        0.123491976262065851077208402915282, 0.134709217311473325928054001771707,
+        0.142775938577060080797094273138717, 0.147739104901338491374841515972068,
+        0.149445554002916905664936468389821]}
+_gaussWeights = {
+    15:[0.129484966168869693270611432679082, 0.279705391489276667901467771423780,
+        0.381830050505118944950369775488975, 0.417959183673469387755102040816327],
+    21:[0.066671344308688137593568809893332, 0.149451349150580593145776339657697,
+        0.219086362515982043995534934228163, 0.269266719309996355091226921569469,
+        0.295524224714752870173892994651146]}
+
+class gaussKronrod:
+    ''' Globally adaptive Gauss-Kronrod quadrature, as in QUADPACK's
+    qag. It's used just like romberg:
+    
+        integral = gaussKronrod(f)
+        integral([a,b],params,tolerance)
+        
+    where f(x) or f(x,params) is the integrand. The interval is
+    split into subintervals, each integrated with a 15-point
+    Kronrod rule and the embedded 7-point Gauss rule (or with rule=21,
+    the 21 and 10 point rules). The difference between the two
+    gives an error estimate, and the subinterval with the largest
+    error is bisected next (they are kept in a priority queue), until
+    the total error estimate is below tolerance, or below relTolerance
+    times the integral. This puts the evaluations where they are
+    needed, e.g. near a sharp peak or an integrable singularity at
+    an endpoint (which is never evaluated). At most maxIntervals
+    subintervals are used. As with romberg, the interval can be
+    infinite, with the optional argument scale.
+    
+    If f accepts arrays of x, the points of both halves of a bisected
+    subinterval are computed in one call of f. vectorized works as in
+    romberg.
+    
+    With fullOutput=True the result is the tuple (value, error, nEval);
+    the error estimate and number of evaluations of f are also kept as
+    the attributes error and nEval.
+    '''
+    
+    def __init__(self,f,rule=15,vectorized=None):
+        if not (rule in _kronrodNodes):
+            print('Error: rule must be 15 or 21')
+            return None
+        self.vectorized = vectorized
+        self.error = None
+        self.nEval = 0
         
         #-------------------------------------------------
         #This snippit of code allows the user to leave the parameter argument
@@ -485,46 +2314,84 @@ class romberg:
             print('Error: %s has wrong number of arguments'%name)
         #-----------------------------------------------------
         
-        #We keep lists of all our results, for doing Romberg extrapolation.
-        #These are re-initialized after each call
-        self.nList = []
-        self.integralList = []
+        #The rule on [-1,1]: all the nodes, and the Kronrod and
+        #Gauss weights of each node (zero for the Kronrod-only nodes)
+        half = np.array(_kronrodNodes[rule])
+        self.nodes = np.concatenate([-half[:-1],half[::-1]])
+        weights = np.array(_kronrodWeights[rule])
+        self.kronrod = np.concatenate([weights[:-1],weights[::-1]])
+        gauss = np.zeros(len(half))
+        gauss[1::2] = _gaussWeights[rule]
+        self.gauss = np.concatenate([gauss[:-1],gauss[::-1]])
         
-    def refine(self):
-        self.trap.refine()
-        self.integralList.append(self.trap.integral)
-        self.nList.append(self.trap.n)
-        dx = [1./(n*n) for n in self.nList]
-        return polint(dx,self.integralList,0.)
+    def __call__(self,interval,params=None,tolerance=1.e-6,relTolerance=0.,
+                 maxIntervals=1000,fullOutput=False,scale=1.):
+        self.integrand,interval = _mapInfinite(self.f,interval,scale)
+        a,b = float(interval[0]),float(interval[1])
+        self.params = params
+        self.nEval = 0
+        value,error = self._rule(np.array([a]),np.array([b]))
+        heap = [(-error[0],a,b,value[0],error[0])]
+        total = value[0]
+        totalError = error[0]
+        while totalError > max(tolerance,relTolerance*abs(total)) and len(heap) < maxIntervals:
+            #Bisect the subinterval with the largest error
+            item = heapq.heappop(heap)
+            a,b = item[1],item[2]
+            m = 0.5*(a+b)
+            values,errors = self._rule(np.array([a,m]),np.array([m,b]))
+            heapq.heappush(heap,(-errors[0],a,m,values[0],errors[0]))
+            heapq.heappush(heap,(-errors[1],m,b,values[1],errors[1]))
+            total += values[0]+values[1]-item[3]
+            totalError += errors[0]+errors[1]-item[4]
+            if not (m > a and b > m):
+                break #The subintervals can't be split any further
+            
+        #Add up again, to get rid of the accumulated round-off
+        self.error = math.fsum([item[4] for item in heap])
+        value = math.fsum([item[3] for item in heap])
+        if fullOutput:
+            return value,self.error,self.nEval
+        return value
+        
+    def _rule(self,a,b):
+        '''Applies the Gauss-Kronrod rule to the intervals [a[i],b[i]].
+        Returns arrays of the integrals and their error estimates, the
+        latter computed as in QUADPACK '''
+        
+        center = 0.5*(a+b)
+        halfLength = 0.5*(b-a)
+        x = center[:,np.newaxis]+halfLength[:,np.newaxis]*self.nodes
+        fx = self._evaluate(x.ravel()).reshape(x.shape)
+        kronrod = np.dot(fx,self.kronrod)
+        gauss = np.dot(fx,self.gauss)
+        #Measures of the size and variation of f, used to scale the error
+        absolute = np.dot(abs(fx),self.kronrod)
+        variation = np.dot(abs(fx-0.5*kronrod[:,np.newaxis]),self.kronrod)
+        error = abs((kronrod-gauss)*halfLength)
+        variation = abs(variation*halfLength)
+        scaled = (variation > 0.) & (error > 0.)
+        error[scaled] = variation[scaled]*np.minimum(1.,(200.*error[scaled]/variation[scaled])**1.5)
+        eps = np.finfo(float).eps
+        error = np.maximum(error,50.*eps*abs(absolute*halfLength))
+        return kronrod*halfLength,error
     
-    def __call__(self,interval,params=None,tolerance=1.e-6):
-        ''' Use a __call__ method to return the result. The
-        __call__ method takes the interval of integration
-        as its mandatory first argument,takes an optional
-        parameter argument as its second argument, and
-        an optional keyword argument specifying the accuracy
-        desired.
-        **ToDo: Introduce trick to allow parameter argument of
-        integrand to be optional, as in Integrator.  Also, make
-        tolerance into a keyword argument
-        '''
+    def _evaluate(self,x):
+        '''Evaluates f at the points x, in one call if possible '''
         
-        self.nList = []
-        self.integralList = []
-        #Make a trapezoidal rule integrator
-        self.trap = BetterTrap(self.f,params,interval,self.nstart)
-        self.nList.append(self.nstart)
-        self.integralList.append(self.trap.integral)
-        #
-        #Refine initial evaluation until 
-        oldval = self.refine()
-        newval = self.refine()
-        while abs(oldval-newval)>tolerance:
-            oldval,newval = newval,self.refine()
-            
-        return newval
+        self.nEval += len(x)
+        if not (self.vectorized == False):
+            try:
+                fx = self.integrand(x,self.params)
+                if np.shape(fx) == np.shape(x):
+                    self.vectorized = True
+                    return np.asarray(fx,dtype=float)
+            except Exception:
+                if self.vectorized:
+                    raise
+            self.vectorized = False
+        return np.array([self.integrand(xi,self.params) for xi in x],dtype=float)
         
-
 class integrator:
     '''
     Runge-Kutta ODE integrator, for 1D or multidimensional problems
@@ -607,6 +2474,22 @@ class integrator:
       return t*z*z+1.
     will work fine.
 
+    If allocating a new array on each call is what you want to avoid
+    (e.g. for a state with thousands of components), write the
+    function with a fourth argument instead, into which it writes
+    the derivatives in place:
+    def g(t,z,params,out):
+      out[0] = z[1]
+      out[1] = -z[0]
+    The integrator recognizes this form by the number of arguments,
+    and then owns the buffers for the Runge-Kutta stages and reuses
+    them from one step to the next; with the rk4 method the stages
+    and y itself are then updated in place, without allocating
+    any new arrays. y must then be an array. The function should
+    write every element of out, and should not keep a reference to
+    out or y. (With dopri5 this form works too, but the stages
+    are still allocated on each step.)
+
     Once you have defined the derivitave function, 
     you then proceed as follows.
 
@@ -635,11 +2518,112 @@ class integrator:
     the value of the dependent variable(s) at the incremented
     independent variable. 
     
+    Adaptive steps
+    --------------
+    By default the integrator takes fixed steps with the classical
+    fourth order Runge-Kutta method. With
+    
+    int_g = integrator(g,0.,start,method='dopri5',rtol=1.e-6,atol=1.e-9)
+    
+    it instead uses the Dormand-Prince 5(4) method, which estimates
+    the error of each step, and chooses the step size so that the
+    error in each component of y stays below about atol+rtol*abs(y).
+    Each call to next() then takes one step of the size it has
+    chosen (a step with a too large error is retried with a smaller
+    step), and int_g.dx is the step size it will try next. An
+    increment given to next() is used as the next step to try. If no
+    step size is given at all, the first one is estimated from g.
+    After a step, int_g.dense(x) interpolates y (to fifth order) at
+    any x within that step. The last derivative evaluation of a step
+    is reused as the first one of the next step.
+    
+    Ensembles
+    ---------
+    To integrate the same equations from many initial states at once,
+    give a 2D starting state of shape (members,dims), one row per
+    ensemble member, and write g so that it works on the whole array
+    at once, e.g. for the harmonic oscillator
+    def g(t,z):
+      return np.stack([z[:,1],-z[:,0]],axis=1)
+    Each Runge-Kutta stage is then one call of g for all the members.
+    With the rk4 method nothing else changes. With dopri5 there are
+    two choices:
+    
+    int_g = integrator(g,0.,start,method='dopri5',stepControl='shared')
+    
+    (the default) takes the same step for all members, chosen from the
+    member with the largest error, so int_g.x stays a scalar. With
+    stepControl='member' each member gets its own step size, and
+    int_g.x and int_g.dx become arrays with one value per member;
+    g is then called with x as a column of shape (members,1), so
+    that it broadcasts against the rows of y. A call of next()
+    tries one step for every member; members whose step is rejected
+    stay where they are, with a smaller step size for the next try.
+    Use e.g. "while int_g.x.min() < 500:" to integrate the whole
+    ensemble to a given x. A member whose step size underflows (e.g.
+    because its solution blows up) is stopped where it is, and marked
+    in the boolean array int_g.failed, while the others go on; loop
+    over the members that haven't failed in that case. In a whole
+    trajectory (see below) the output of a failed member after it
+    stopped is nan.
+    
+    Whole trajectories
+    ------------------
+    Instead of calling next() in a loop, you can call the integrator
+    object itself, which integrates all the way to a given x:
+    
+    x,y = int_g(500.,nOut=101)
+    
+    returns the solution at 101 evenly spaced points from the current
+    x to 500 (or at the points in an array, with xOut=...), in arrays
+    allocated once at the start. y has one row per output point. For
+    the rk4 method the step before an output point is shortened so
+    that it lands on the point; dopri5 interpolates with dense().
+    Without nOut or xOut (or with nOut=1), only the end point is
+    returned. With curve=True the result is returned as a Curve, with columns 'x'
+    and 'y' (or 'y0','y1',... for a system). The integrator is left
+    at the end point, so a further call continues from there. It only
+    integrates forward: output points behind the current x are an
+    error. If the step size underflows (e.g. when the solution blows
+    up), the output points reached so far are returned.
+    
+    int_g.reset() puts the integrator back to its initial conditions,
+    so the same object can be reused, e.g. for a sweep over params:
+    
+    for a in [1.,2.,3.]:
+        int_g.reset()
+        int_g.setParams(a)
+        x,y = int_g(10.,nOut=50)
+    
+    reset() also accepts new starting values, as reset(ystart,xstart).
+    
+    Events
+    ------
+    To find where the solution crosses some threshold (e.g. where the
+    temperature reaches the condensation point), define a function of
+    x and y (and params, optionally) which changes sign there, and add
+    it as an event:
+    
+    def condensation(x,y):
+      return y[0]-Tcond
+    int_g.addEvent(condensation,terminal=True,direction=1)
+    
+    After each step the integrator checks for a change of sign of each
+    event function, and locates the crossing within the step by root
+    finding on an interpolation of the step (dense() for dopri5, a cubic
+    Hermite interpolation for rk4). Each crossing found is appended
+    to int_g.events as a tuple (x,y,i), where i is the number of the
+    event, in the order they were added. With direction=1 (or -1)
+    only crossings from negative to positive values (or the other way
+    around) are counted. If a terminal event is found, the integrator
+    stops at the crossing, with int_g.x and int_g.y set to the
+    crossing, and sets int_g.terminated to True. A call of the
+    integrator object then returns the output points up to the
+    crossing, followed by the crossing itself; next() continues
+    past it if you call it again. Events are not available for
+    ensembles with per-member step sizes.
+    
     **ToDo:
-         * Implement a reset() method which resets to initial conditions.
-            Useful for doing problem over multiple times with different
-            parameters.
-            
          * Referring to the independent variable as 'x' is awful, and
            confusing in many contexts.  Introduce a variable name
            dictonary with default names like 'independent' and 'dependent'
@@ -658,13 +2642,10 @@ class integrator:
            refer to the different vector components by name
            (e.g. refer to v[0] at T, v[1] as dTdy , etc. )
            
-         * Make the integrator object callable. The call can return
-           a list of results for all the intermediate steps, or optionally
-           just the final value.  
-
     '''
 
-    def __init__(self, derivs,xstart,ystart,dx=None):
+    def __init__(self, derivs,xstart,ystart,dx=None,method='rk4',rtol=1.e-6,atol=1.e-9,
+                 stepControl='shared'):
         self.derivsin = derivs
         #
         #The following block checks to see if the derivs
@@ -674,8 +2655,17 @@ class integrator:
         #out the parameter argument from the function definition,
         #if it isn't needed.
         nargs = derivs.__code__.co_argcount
+        self.inPlace = (nargs == 4)
         if nargs == 3:
             self.derivs = derivs
+        elif nargs == 4:
+            #In-place form. This wrapper is for the code which
+            #needs a new array for each evaluation
+            def derivs1(x,y,param):
+                out = np.empty(np.shape(y))
+                self.derivsin(x,y,param,out)
+                return out
+            self.derivs = derivs1
         elif nargs == 2:
             def derivs1(x,y,param):
                 return self.derivsin(x,y)
@@ -691,6 +2681,111 @@ class integrator:
         self.y = 0.+ ystart
         self.dx = dx #Can instead be set with the first call to next()
         self.params = None
+        if not (method in ['rk4','dopri5']):
+            print('Error: unknown method %s'%method)
+        self.method = method
+        if not (stepControl in ['shared','member']):
+            print('Error: unknown stepControl %s'%stepControl)
+        #Separate step sizes only make sense for an ensemble
+        self.memberSteps = (stepControl == 'member') and (method == 'dopri5') \
+            and (np.ndim(self.y) == 2)
+        if self.memberSteps:
+            self.x = np.zeros(self.y.shape[0])+xstart
+        #Members whose step size underflowed, with stepControl='member'
+        self.failed = np.zeros(len(self.x),dtype=bool) if self.memberSteps else None
+        self.rtol = rtol
+        self.atol = atol
+        self._fsal = None  #(x,y,dy/dx) at the end of the last dopri5 step, with a
+                           #copy of y, so that changes of self.y are noticed
+        self._dense = None #Interpolation coefficients of the last dopri5 step
+        self._start = (xstart,0.+ystart,dx) #Kept for reset()
+        self._stages = None #Buffers for the in-place derivative form
+        self.eventFuncs = [] #(function,terminal,direction) for each event
+        self.events = []
+        self.terminated = False
+        self._eventValues = None #Event functions at the current x
+
+    def reset(self,ystart=None,xstart=None):
+        '''
+        Resets the integrator to its initial conditions, or to
+        new ones if ystart and/or xstart are given. The parameters
+        set with setParams are kept.
+        '''
+
+        x0,y0,dx0 = self._start
+        if ystart is not None:
+            y0 = 0.+ystart
+        if xstart is not None:
+            x0 = xstart
+        self._start = (x0,y0,dx0)
+        self.x = np.zeros(np.shape(y0)[0])+x0 if self.memberSteps else x0
+        self.failed = np.zeros(len(self.x),dtype=bool) if self.memberSteps else None
+        self.y = 0.+y0
+        self.dx = dx0
+        self._fsal = None
+        self._dense = None
+        self.events = []
+        self.terminated = False
+        self._eventValues = None
+
+    def addEvent(self,func,terminal=False,direction=0):
+        '''
+        Adds an event function func(x,y) or func(x,y,params). Its
+        crossings of zero are found at each step, and stop the
+        integration if terminal is True (see the class documentation).
+        '''
+
+        if self.memberSteps:
+            print('Error: events need a step size shared by all members')
+            return
+        if func.__code__.co_argcount == 2:
+            def func1(x,y,param):
+                return func(x,y)
+            self.eventFuncs.append((func1,terminal,direction))
+        else:
+            self.eventFuncs.append((func,terminal,direction))
+        self._eventValues = None
+
+    def _checkEvents(self,x0,y0):
+        '''Looks for crossings of the event functions in the step
+        from (x0,y0) to the current x and y '''
+
+        params = self.params
+        if self._eventValues is None:
+            self._eventValues = [f(x0,y0,params) for f,terminal,direction in self.eventFuncs]
+        values = [f(self.x,self.y,params) for f,terminal,direction in self.eventFuncs]
+        interp = None
+        found = []
+        for i,(f,terminal,direction) in enumerate(self.eventFuncs):
+            g0,g1 = self._eventValues[i],values[i]
+            if ((g0 < 0. <= g1) and direction >= 0) or ((g0 > 0. >= g1) and direction <= 0):
+                if interp is None:
+                    interp = self._stepInterpolant(x0,y0)
+                found.append((_findEventRoot(lambda x: f(x,interp(x),params),
+                                             x0,self.x,g0,g1),i))
+        self._eventValues = values
+        for xe,i in sorted(found):
+            ye = interp(xe)
+            self.events.append((xe,ye,i))
+            if self.eventFuncs[i][1]:
+                self.x,self.y = xe,ye
+                self.terminated = True
+                #Start again from the event, so that crossings later in
+                #the step are found by the next one. The function that
+                #stopped the integration keeps its value past the crossing.
+                self._eventValues = [values[j] if j == i else f(xe,ye,params)
+                                     for j,(f,terminal,direction) in enumerate(self.eventFuncs)]
+                break
+
+    def _stepInterpolant(self,x0,y0):
+        '''Returns a function interpolating y within the last step '''
+
+        if self.method == 'dopri5':
+            return self.dense
+        x1,y1 = self.x,self.y
+        f0 = self.derivs(x0,y0,self.params)
+        f1 = self.derivs(x1,y1,self.params)
+        return lambda x: _hermite(x,x0,x1-x0,y0,f0,y1,f1)
 
     def setParams(self,params):
         '''
@@ -701,6 +2796,7 @@ class integrator:
         '''
 
         self.params = params
+        self._fsal = None
 
     def next(self,dx = None):
         '''
@@ -713,10 +2809,176 @@ class integrator:
            Handle arithmetic exceptions in the iteration loop
         '''
 
-        if not (dx == None):
+        if not (dx is None):
             self.dx = dx
-            
-        h = self.dx
+        self.terminated = False
+        if self.method == 'dopri5':
+            return self._dopriNext()
+        if self.eventFuncs:
+            x0,y0 = self.x,0.+self.y
+            self._rk4Step(self.dx)
+            self._checkEvents(x0,y0)
+            return self.x,self.y
+        return self._rk4Step(self.dx)
+
+    def __call__(self,xEnd,nOut=None,xOut=None,curve=False):
+        '''
+        Integrates to xEnd, and returns the solution at the output
+        points xOut (default: nOut evenly spaced points from the
+        current x to xEnd, or just xEnd) as arrays x,y, or as a Curve
+        if curve is True. See the class documentation.
+        '''
+
+        if xOut is None:
+            if nOut is None or nOut == 1:
+                xOut = np.array([xEnd],float)
+            elif nOut < 1:
+                print('Error: nOut must be at least 1')
+                return None
+            else:
+                xOut = np.linspace(np.min(self.x),xEnd,nOut)
+        else:
+            xOut = np.asarray(xOut,float)
+            xEnd = xOut[-1]
+        if self.method == 'rk4' and not (self.dx is not None and self.dx > 0.):
+            print('Error: the rk4 method needs a positive step size dx')
+            return None
+        if np.min(xOut) < np.min(self.x):
+            print('Error: output points behind the current x = %g'%np.min(self.x))
+            return None
+        yOut = np.empty((len(xOut),)+np.shape(self.y))
+        self.terminated = False
+        if self.method == 'rk4':
+            n = self._rk4Trajectory(xOut,yOut)
+        elif self.memberSteps:
+            n = self._dopriTrajectoryMembers(xOut,yOut,xEnd)
+        else:
+            n = self._dopriTrajectory(xOut,yOut,xEnd)
+        if self.terminated:
+            #Stopped by an event: the output up to it, and the event
+            xOut = np.append(xOut[:n],self.x)
+            yOut = np.concatenate([yOut[:n],[self.y]])
+        elif n < len(xOut):
+            #Stopped by a step size underflow: the output reached
+            xOut,yOut = xOut[:n],yOut[:n]
+        if not curve:
+            return xOut,yOut
+        return _trajectoryCurve(xOut,yOut)
+
+    def _rk4Trajectory(self,xOut,yOut):
+        '''Fixed rk4 steps through the output points, shortening the
+        step before each point so that it lands on the point. The
+        loop is the same as in _rk4Step, written out with local
+        names to save the call overhead of each step. Returns the
+        number of output points reached. '''
+
+        derivs,params = self.derivs,self.params
+        x,y,h = self.x,self.y,self.dx
+        events = len(self.eventFuncs) > 0
+        for i,xo in enumerate(xOut):
+            #A last step of up to 1.0001*h is taken, rather than
+            #a very short extra one. A point closer than that to x
+            #is reached with one short step.
+            nSteps = int(math.ceil((xo-x)/h-1.e-4))
+            if nSteps == 0 and xo > x:
+                nSteps = 1
+            for n in range(nSteps):
+                hs = h if n < nSteps-1 else xo-x
+                if events:
+                    x0,y0 = x,0.+y
+                if self.inPlace:
+                    self._rk4InPlace(x,y,hs)
+                else:
+                    hh = hs*0.5
+                    dydx = derivs(x,y,params)
+                    dyt = derivs(x+hh,y+hh*dydx,params)
+                    dym = derivs(x+hh,y+hh*dyt,params)
+                    yt = y+hs*dym
+                    dym += dyt
+                    dyt = derivs(x+hs,yt,params)
+                    y += (hs/6.0)*(dydx+dyt+2.0*dym)
+                x = xo if n == nSteps-1 else x+hs
+                if events:
+                    self.x,self.y = x,y
+                    self._checkEvents(x0,y0)
+                    if self.terminated:
+                        return i
+            yOut[i] = y
+        self.x,self.y = x,y
+        return len(xOut)
+
+    def _dopriTrajectory(self,xOut,yOut,xEnd):
+        '''Adaptive steps to xEnd, with the output from dense output.
+        Returns the number of output points reached. '''
+
+        i = 0
+        while i < len(xOut) and xOut[i] <= self.x:
+            yOut[i] = self.y
+            i += 1
+        self._firstDopriStep()
+        while self.x < xEnd:
+            if self.x+1.0001*self.dx >= xEnd:
+                #Land the last step on xEnd
+                self.dx = xEnd-self.x
+            x0 = self.x
+            self._dopriNext()
+            if self.x == x0:
+                #The step size underflowed
+                break
+            if self.x+1.e-12*abs(xEnd) >= xEnd:
+                self.x = xEnd
+                self._fsal = (self.x,)+self._fsal[1:]
+            while i < len(xOut) and xOut[i] <= self.x:
+                yOut[i] = self.y if xOut[i] == self.x else self.dense(xOut[i])
+                i += 1
+            if self.terminated:
+                break
+        return i
+
+    def _dopriTrajectoryMembers(self,xOut,yOut,xEnd):
+        '''Same as _dopriTrajectory, for an ensemble in which each
+        member has its own step size. Returns the number of output
+        points (all of them: members which fail get nan instead). '''
+
+        for i,xo in enumerate(xOut):
+            start = xo <= self.x
+            yOut[i][start] = self.y[start]
+        self._firstDopriStep()
+        while np.any((self.x < xEnd) & ~self.failed):
+            self.dx = np.where(self.x+1.0001*self.dx >= xEnd,xEnd-self.x,self.dx)
+            x0 = self.x
+            self._dopriNext()
+            self.x = np.where(self.x+1.e-12*abs(xEnd) >= xEnd,xEnd,self.x)
+            self._fsal = (self.x,)+self._fsal[1:]
+            #Output points passed in this step, member by member
+            for i in np.nonzero((xOut > x0.min()) & (xOut <= self.x.max()))[0]:
+                passed = (x0 < xOut[i]) & (xOut[i] <= self.x)
+                if np.any(passed):
+                    #Members which have already finished have zero steps
+                    with np.errstate(divide='ignore',invalid='ignore'):
+                        yOut[i][passed] = self.dense(xOut[i])[passed]
+        for i,xo in enumerate(xOut):
+            #Members which failed before reaching the output point
+            yOut[i][self.failed & (self.x < xo)] = np.nan
+        return len(xOut)
+
+    def _firstDopriStep(self):
+        '''Estimates the first step size if there is none yet, keeping
+        the derivative for the first step '''
+
+        if self.dx is None:
+            x = self.x[:,np.newaxis] if self.memberSteps else self.x
+            k1 = self.derivs(x,self.y,self.params)
+            self.dx = self._firstStep(x,self.y,k1)
+            self._fsal = (self.x,np.copy(self.y),k1)
+
+    def _rk4Step(self,h):
+        '''One classical Runge-Kutta step of size h '''
+
+        if self.inPlace:
+            self._rk4InPlace(self.x,self.y,h)
+            self.x += h
+            return self.x,self.y
         hh=h*0.5;
         h6=h/6.0;
         xh=self.x+hh;
@@ -731,6 +2993,600 @@ class integrator:
         self.y += h6*(dydx+dyt+2.0*dym)
         self.x += h
         return self.x,self.y
+    
+    def _rk4InPlace(self,x,y,h):
+        '''Runge-Kutta step of size h which updates y in place, using
+        the in-place form of the derivative function and buffers
+        which are kept from one step to the next '''
+
+        if (self._stages is None) or (self._stages[0].shape != np.shape(y)):
+            self._stages = [np.empty(np.shape(y)) for i in range(5)]
+        k1,k2,k3,k4,yt = self._stages
+        derivs,params = self.derivsin,self.params
+        hh = h*0.5
+        derivs(x,y,params,k1)
+        np.multiply(k1,hh,out=yt)
+        yt += y
+        derivs(x+hh,yt,params,k2)
+        np.multiply(k2,hh,out=yt)
+        yt += y
+        derivs(x+hh,yt,params,k3)
+        np.multiply(k3,h,out=yt)
+        yt += y
+        derivs(x+h,yt,params,k4)
+        #y += h/6*(k1+2*(k2+k3)+k4)
+        k2 += k3
+        k2 *= 2.
+        k1 += k2
+        k1 += k4
+        k1 *= h/6.0
+        y += k1
+
+    def _dopriNext(self):
+        '''Takes one adaptive Dormand-Prince step (see the class documentation) '''
+        
+        if self.memberSteps:
+            return self._dopriNextMembers()
+        x,y = self.x,self.y
+        if (self._fsal is not None) and (self._fsal[0] == x) and \
+           np.array_equal(self._fsal[1],y):
+            k1 = self._fsal[2]
+        else:
+            k1 = self.derivs(x,y,self.params)
+        if self.dx is None:
+            self.dx = self._firstStep(x,y,k1)
+        h = self.dx
+        facmax = 5.
+        while True:
+            ynew,k,err = self._dopriStep(x,y,k1,h)
+            if err <= 1.:
+                break
+            #Reject the step, and try again with a smaller one
+            h = float(h*max(0.2,0.9*err**-0.2))
+            facmax = 1.
+            if x+h == x:
+                print('Error: step size underflow at x = %g'%x)
+                return self.x,self.y
+        
+        #Dense output coefficients (Hairer's contd5)
+        ydiff = ynew-y
+        bspl = h*k1-ydiff
+        self._dense = (x,h,y,ydiff,bspl,ydiff-h*k[6]-bspl,h*(_dopriDense[0]*k1+
+            _dopriDense[2]*k[2]+_dopriDense[3]*k[3]+_dopriDense[4]*k[4]+
+            _dopriDense[5]*k[5]+_dopriDense[6]*k[6]))
+        self.x = x+h
+        self.y = ynew
+        self._fsal = (self.x,np.copy(self.y),k[6])
+        #Step size for the next step
+        self.dx = float(h*min(facmax,max(0.2,0.9*max(err,1.e-10)**-0.2)))
+        if self.eventFuncs:
+            self._checkEvents(x,y)
+        return self.x,self.y
+    
+    def _dopriNextMembers(self):
+        '''Tries one Dormand-Prince step for each member of an ensemble,
+        each with its own step size '''
+        
+        x,y = self.x[:,np.newaxis],self.y
+        if (self._fsal is not None) and np.array_equal(self._fsal[0],self.x) and \
+           np.array_equal(self._fsal[1],y):
+            k1 = self._fsal[2]
+        else:
+            k1 = self.derivs(x,y,self.params)
+        if self.dx is None:
+            self.dx = self._firstStep(x,y,k1)
+        #One step size per member, as a column
+        h = np.zeros(x.shape)+np.reshape(self.dx,(-1,1))
+        ynew,k,err = self._dopriStep(x,y,k1,h)
+        accept = err <= 1.
+        underflow = ~accept[:,0] & (x+h == x)[:,0]
+        if np.any(underflow):
+            #Stop these members, and let the others go on
+            print('Error: step size underflow for members %s'%np.flatnonzero(underflow))
+            self.failed |= underflow
+        
+        #Dense output coefficients, for the members whose step was accepted
+        ydiff = ynew-y
+        bspl = h*k1-ydiff
+        self._dense = (x,h,y,ydiff,bspl,ydiff-h*k[6]-bspl,h*(_dopriDense[0]*k1+
+            _dopriDense[2]*k[2]+_dopriDense[3]*k[3]+_dopriDense[4]*k[4]+
+            _dopriDense[5]*k[5]+_dopriDense[6]*k[6]))
+        self.x = np.where(accept,x+h,x)[:,0]
+        self.y = np.where(accept,ynew,y)
+        self._fsal = (self.x,np.copy(self.y),np.where(accept,k[6],k1))
+        #Members whose step was rejected retry with a smaller one
+        #(fmax so that a nan error, e.g. from an overflow, shrinks the step too)
+        self.dx = (h*np.minimum(5.,np.fmax(0.2,0.9*np.maximum(err,1.e-10)**-0.2)))[:,0]
+        self.dx[self.failed] = 0.
+        return self.x,self.y
+    
+    def _dopriStep(self,x,y,k1,h):
+        '''Trial step of size h. Returns the new y, the stages, and the
+        error estimate, scaled so that 1 is the tolerance '''
+        
+        k = [k1]
+        for i in range(1,7):
+            yt = y
+            for j in range(i):
+                if not (_dopriA[i][j] == 0.):
+                    yt = yt+(h*_dopriA[i][j])*k[j]
+            k.append(self.derivs(x+_dopriC[i]*h,yt,self.params))
+        #The last stage is evaluated at the new y
+        ynew = yt
+        yerr = 0.
+        for j in range(7):
+            if not (_dopriE[j] == 0.):
+                yerr = yerr+(h*_dopriE[j])*k[j]
+        return ynew,k,self._errorNorm(yerr,y,ynew)
+    
+    def _errorNorm(self,yerr,y,ynew):
+        '''RMS norm of the error, relative to atol+rtol*abs(y). For an
+        ensemble, this is the norm of the worst member, or a column
+        with the norm of each member if they have their own step sizes '''
+        
+        scale = self.atol+self.rtol*np.maximum(abs(y),abs(ynew))
+        if np.ndim(yerr) == 2:
+            err = np.sqrt(np.mean((yerr/scale)**2,axis=1,keepdims=True))
+            return err if self.memberSteps else err.max()
+        return np.sqrt(np.mean((yerr/scale)**2))
+    
+    def _firstStep(self,x,y,dydx):
+        '''Estimates a good size for the first step (as in Hairer,
+        Norsett and Wanner, Solving ODEs I, II.4) '''
+        
+        d0 = self._errorNorm(y,y,y)
+        d1 = self._errorNorm(dydx,y,y)
+        #Written with array operations, so that members of an
+        #ensemble each get their own estimate
+        small = (d0 < 1.e-5) | (d1 < 1.e-5)
+        h0 = np.where(small,1.e-6,0.01*d0/np.where(small,1.,d1))
+        dydx1 = self.derivs(x+h0,y+h0*dydx,self.params)
+        d2 = self._errorNorm(dydx1-dydx,y,y)/h0
+        dmax = np.maximum(d1,d2)
+        h1 = np.where(dmax <= 1.e-15,np.maximum(1.e-6,h0*1.e-3),
+                      (0.01/np.maximum(dmax,1.e-15))**0.2)
+        h = np.minimum(100.*h0,h1)
+        return float(h) if np.ndim(h) == 0 else h[:,0]
+    
+    def dense(self,x):
+        '''Interpolates y at x, which should lie within the last step
+        taken with the dopri5 method '''
+        
+        if self._dense is None:
+            print('Error: dense output needs a step with the dopri5 method')
+            return None
+        x0,h,r1,r2,r3,r4,r5 = self._dense
+        theta = (x-x0)/h
+        theta1 = 1.-theta
+        return r1+theta*(r2+theta1*(r3+theta*(r4+theta1*r5)))
+
+#Coefficients of the Dormand-Prince 5(4) method: nodes, Runge-Kutta
+#matrix (the last row are the fifth-order weights), the weights of
+#the error estimate (fifth minus fourth order), and the weights of
+#the dense output
+_dopriC = [0., 1./5., 3./10., 4./5., 8./9., 1., 1.]
+_dopriA = [[],
+           [1./5.],
+           [3./40., 9./40.],
+           [44./45., -56./15., 32./9.],
+           [19372./6561., -25360./2187., 64448./6561., -212./729.],
+           [9017./3168., -355./33., 46732./5247., 49./176., -5103./18656.],
+           [35./384., 0., 500./1113., 125./192., -2187./6784., 11./84.]]
+_dopriE = [71./57600., 0., -71./16695., 71./1920., -17253./339200., 22./525., -1./40.]
+_dopriDense = [-12715105075./11282082432., 0., 87487479700./32700410799.,
+               -10690763975./1880347072., 701980252875./199316789632.,
+               -1453857185./822651844., 69997945./29380423.]
+
+def _trajectoryCurve(xOut,yOut):
+    '''Returns the output of an integrator call as a Curve '''
+
+    if yOut.ndim > 2:
+        print('Error: an ensemble can not be returned as a Curve')
+        return xOut,yOut
+    c = Curve()
+    c.addCurve(xOut,'x')
+    if yOut.ndim == 1:
+        c.addCurve(yOut,'y')
+    else:
+        for i in range(yOut.shape[1]):
+            c.addCurve(yOut[:,i],'y%d'%i)
+    return c
+
+def _hermite(x,x0,h,y0,f0,y1,f1):
+    '''Cubic Hermite interpolation within a step of size h from x0,
+    given y and dy/dx at both ends '''
+
+    theta = (x-x0)/h
+    return (1.-theta)*y0+theta*y1+theta*(theta-1.)*((1.-2.*theta)*(y1-y0)
+                                                   +h*(theta-1.)*f0+h*theta*f1)
+
+def _findEventRoot(g,a,b,ga,gb):
+    '''Finds the zero of g between a and b, where g has the values
+    ga and gb of opposite sign, with the Illinois variant of
+    regula falsi '''
+
+    tol = 4.*np.finfo(float).eps*max(abs(a),abs(b),1.e-300)
+    side = 0
+    for i in range(100):
+        c = (a*gb-b*ga)/(gb-ga)
+        if abs(b-a) <= tol:
+            break
+        gc = g(c)
+        if gc == 0.:
+            break
+        if (gc > 0.) == (gb > 0.):
+            b,gb = c,gc
+            if side == -1:
+                ga *= 0.5
+            side = -1
+        else:
+            a,ga = c,gc
+            if side == 1:
+                gb *= 0.5
+            side = 1
+    return c
+
+#Constants of the Rosenbrock 2(3) pair of Shampine and Reichelt (ode23s)
+_rosD = 1./(2.+math.sqrt(2.))
+_rosE32 = 6.+math.sqrt(2.)
+
+class stiffIntegrator:
+    '''
+    Implicit (Rosenbrock) ODE integrator, for stiff problems
+
+    Usage
+    -----
+    The derivative function is written just as for integrator, with
+    or without the params argument (or with the out argument of the
+    in-place form), and the stiff integrator is used the same way:
+
+    int_g = stiffIntegrator(g,0.,start,rtol=1.e-6,atol=1.e-9)
+    int_g.setParams(myParams)
+    while int_g.x < 500:
+       print int_g.next()
+
+    or x,y = int_g(500.,nOut=101) for a whole trajectory, which
+    also has reset() like integrator. y can be a scalar or a 1D array.
+
+    Problems are stiff when some of their components relax much faster
+    than the solution you are interested in changes (e.g. radiative
+    relaxation of thin layers in a column model). An explicit method
+    like integrator then needs steps as short as the fastest relaxation
+    time, even when nothing is happening on that time scale. This
+    integrator uses the Rosenbrock 2(3) pair of Shampine and Reichelt
+    (as in Matlab's ode23s), which is stable for any step size, and
+    chooses the steps to keep the error of each component of y
+    below about atol+rtol*abs(y). Each call to next() takes one step.
+    int_g.dense(x) interpolates y (cubic Hermite) within the last step.
+
+    Jacobian
+    --------
+    The method needs the Jacobian matrix dg/dy. By default it is
+    computed by finite differences, which takes one evaluation
+    of g per component of y. If you know it, pass a function
+    returning it (as an array, or a scipy sparse matrix) with
+    jac=..., with the same arguments as g (x,y, and params if g
+    has them). If each derivative only depends on nearby components
+    (e.g. a discretized diffusion equation) declare that with
+    bandwidth = (lower,upper), the number of nonzero diagonals below
+    and above the main one. The finite-difference Jacobian then
+    needs only lower+upper+1 evaluations of g, and the linear
+    algebra uses a sparse LU factorization.
+
+    The Jacobian and the LU factorization of I-h*d*J are kept from
+    one step to the next. The Jacobian is recomputed when a step
+    fails, and the factorization when the step size changes; small
+    increases of the step size are skipped to keep the
+    factorization. The counts are in int_g.nEval (evaluations of g),
+    int_g.nJac and int_g.nLU. The method also needs dg/dx, which
+    takes one more evaluation of g per step, unless you declare that
+    g does not depend on x with autonomous=True.
+
+    If scipy is available it is used for the LU factorizations.
+    Otherwise, numpy is used, with dense matrices even for banded
+    problems, which is fine for up to a few hundred components.
+    '''
+
+    def __init__(self,derivs,xstart,ystart,dx=None,rtol=1.e-6,atol=1.e-9,
+                 jac=None,bandwidth=None,autonomous=False):
+        self.derivsin = derivs
+        #
+        #The following block checks to see if the derivs
+        #function has a parameter argument specified, and
+        #writes a new function with a dummy parameter argument
+        #appended if necessary. This allows the user to leave
+        #out the parameter argument from the function definition,
+        #if it isn't needed.
+        nargs = derivs.__code__.co_argcount
+        if nargs == 3:
+            self.derivs = derivs
+        elif nargs == 4:
+            def derivs1(x,y,param):
+                out = np.empty(np.shape(y))
+                self.derivsin(x,y,param,out)
+                return out
+            self.derivs = derivs1
+        elif nargs == 2:
+            def derivs1(x,y,param):
+                return self.derivsin(x,y)
+            self.derivs = derivs1
+        else:
+            name = derivs.__name__
+            print('Error: %s has wrong number of arguments'%name)
+        #Same for the Jacobian
+        self.jacin = jac
+        if jac is None:
+            self.jac = None
+        elif jac.__code__.co_argcount == 3:
+            self.jac = jac
+        else:
+            def jac1(x,y,param):
+                return self.jacin(x,y)
+            self.jac = jac1
+        #
+        self.scalar = (np.ndim(ystart) == 0)
+        self.bandwidth = bandwidth
+        self.autonomous = autonomous
+        self.rtol = rtol
+        self.atol = atol
+        self.params = None
+        self._start = (xstart,0.+ystart,dx) #Kept for reset()
+        self.reset()
+
+    def reset(self,ystart=None,xstart=None):
+        '''
+        Resets the integrator to its initial conditions, or to
+        new ones if ystart and/or xstart are given. The parameters
+        set with setParams are kept.
+        '''
+
+        x0,y0,dx0 = self._start
+        if ystart is not None:
+            y0 = 0.+ystart
+        if xstart is not None:
+            x0 = xstart
+        self._start = (x0,y0,dx0)
+        self.x = x0
+        self.y = 0.+y0
+        self.dx = dx0
+        self._y = np.array(y0,float).reshape(-1) #y as a 1D array
+        self._f = None     #dy/dx at the current x
+        self._J = None     #(Jacobian, whether it is for the current y)
+        self._lu = None    #(h, solve function) for I-h*d*J
+        self._last = None  #(x0,h,y0,f0,y1,f1) of the last step
+        self.nEval = 0
+        self.nJac = 0
+        self.nLU = 0
+
+    def setParams(self,params):
+        '''
+        Sets the parameters for the integrator (optional).
+        The argument can be any Python entity at all. It is
+        up to the user to make sure the derivative function can
+        make use of it.
+        '''
+
+        self.params = params
+        self._f = None
+        self._J = None
+        self._lu = None
+
+    def _eval(self,x,y):
+        '''The derivatives, as a 1D array '''
+
+        self.nEval += 1
+        f = self.derivs(x,y[0] if self.scalar else y,self.params)
+        return np.array(f,float).reshape(-1)
+
+    def _jacobian(self,x,y,f):
+        '''Computes the Jacobian (dense, or sparse if the problem is
+        banded and scipy is available) at (x,y) '''
+
+        self.nJac += 1
+        n = len(y)
+        if self.jac is not None:
+            J = self.jac(x,y[0] if self.scalar else y,self.params)
+            if not ((scipy is not None) and scipy.sparse.issparse(J)):
+                J = np.array(J,float).reshape(n,n)
+        elif self.bandwidth is None:
+            J = np.empty((n,n))
+            for j in range(n):
+                df,delta = self._difference(x,y,f,[j])
+                J[:,j] = df/delta[j]
+        else:
+            #Columns which are more than a bandwidth apart don't
+            #affect the same derivatives, so they are perturbed together
+            lower,upper = self.bandwidth
+            w = lower+upper+1
+            ab = np.zeros((w,n)) #LAPACK band storage, ab[upper+i-j,j] = J[i,j]
+            for g in range(min(w,n)):
+                cols = np.arange(g,n,w)
+                df,delta = self._difference(x,y,f,cols)
+                for k in range(-upper,lower+1):
+                    c = cols[(cols+k >= 0) & (cols+k < n)]
+                    ab[upper+k,c] = df[c+k]/delta[c]
+            if scipy is not None:
+                J = scipy.sparse.dia_matrix((ab,np.arange(upper,-lower-1,-1)),shape=(n,n)).tocsc()
+            else:
+                J = np.zeros((n,n))
+                for k in range(-upper,lower+1):
+                    j = np.arange(max(0,-k),min(n,n-k))
+                    J[j+k,j] = ab[upper+k,j]
+        self._J = (J,True)
+        self._lu = None
+
+    def _difference(self,x,y,f,cols):
+        '''Change of f when the components cols of y are perturbed
+        together, and the perturbations '''
+
+        delta = np.zeros(len(y))
+        delta[cols] = math.sqrt(np.finfo(float).eps)*np.maximum(abs(y[cols]),self.atol/max(self.rtol,1.e-16))
+        yp = y+delta
+        delta = yp-y  #The increments actually taken, after rounding
+        return self._eval(x,yp)-f,delta
+
+    def _factor(self,h):
+        '''Factors W = I-h*d*J, and stores a function solving W z = b '''
+
+        self.nLU += 1
+        J = self._J[0]
+        n = len(self._y)
+        if (scipy is not None) and scipy.sparse.issparse(J):
+            lu = scipy.sparse.linalg.splu((scipy.sparse.identity(n,format='csc')-(h*_rosD)*J).tocsc())
+            solve = lu.solve
+        elif scipy is not None:
+            lu = scipy.linalg.lu_factor(np.eye(n)-(h*_rosD)*J)
+            solve = lambda b: scipy.linalg.lu_solve(lu,b)
+        else:
+            if not isinstance(J,np.ndarray):
+                J = J.toarray()
+            Winv = np.linalg.inv(np.eye(n)-(h*_rosD)*J)
+            solve = lambda b: Winv.dot(b)
+        self._lu = (h,solve)
+
+    def _errorNorm(self,yerr,y,ynew):
+        '''RMS norm of the error, relative to atol+rtol*abs(y) '''
+
+        scale = self.atol+self.rtol*np.maximum(abs(y),abs(ynew))
+        return np.sqrt(np.mean((yerr/scale)**2))
+
+    def next(self,dx = None):
+        '''
+        Takes one step. Optionally, takes the size of the step
+        to try as an argument (see the class documentation).
+        '''
+
+        #A step size given here is taken as it is
+        snap = dx is None
+        if not (dx is None):
+            self.dx = dx
+        self._syncY()
+        x,y = self.x,self._y
+        self._firstStep()
+        f0 = self._f
+        if self._J is None:
+            self._jacobian(x,y,f0)
+        if self.autonomous:
+            T = 0.
+        else:
+            #df/dx is needed at each step, unlike the Jacobian
+            dx = math.sqrt(np.finfo(float).eps)*max(abs(x),abs(self.dx))
+            T = (self._eval(x+dx,y)-f0)/dx
+        h = self.dx
+        while True:
+            #Keep the factorization for a small increase of the step
+            if snap and (self._lu is not None) and (self._lu[0] <= h <= 1.2*self._lu[0]):
+                h = self._lu[0]
+            if (self._lu is None) or (self._lu[0] != h):
+                self._factor(h)
+            solve = self._lu[1]
+            current = self._J[1]
+            hdT = (h*_rosD)*T
+            k1 = solve(f0+hdT)
+            f1 = self._eval(x+0.5*h,y+(0.5*h)*k1)
+            k2 = solve(f1-k1)+k1
+            ynew = y+h*k2
+            f2 = self._eval(x+h,ynew)
+            k3 = solve(f2-_rosE32*(k2-f1)-2.*(k1-f0)+hdT)
+            err = self._errorNorm((h/6.)*(k1-2.*k2+k3),y,ynew)
+            if err <= 1.:
+                break
+            if not current:
+                #Try again with a Jacobian for the current y
+                self._jacobian(x,y,f0)
+            else:
+                h = h*max(0.2,0.8*err**(-1./3.))
+            if x+h == x:
+                print('Error: step size underflow at x = %g'%x)
+                return self.x,self.y
+        self._last = (x,h,y,f0,ynew,f2)
+        self.x = x+h
+        self._y = ynew
+        self.y = ynew[0] if self.scalar else ynew.copy()
+        self._f = f2
+        self._J = (self._J[0],False)
+        self.dx = h*min(5.,max(0.2,0.8*max(err,1.e-10)**(-1./3.)))
+        return self.x,self.y
+
+    def _syncY(self):
+        '''Takes over a new value of self.y, set by the user (also in
+        place), dropping dy/dx and the Jacobian, which were for the old one '''
+
+        y = np.array(self.y,float).reshape(-1)
+        if not np.array_equal(y,self._y):
+            self._y = y
+            self._f = None
+            self._J = None
+            self._lu = None
+
+    def _firstStep(self):
+        '''Evaluates dy/dx at the current x if needed, and estimates
+        the first step size from the size of y and dy/dx if there is none '''
+
+        if self._f is None:
+            self._f = self._eval(self.x,self._y)
+        if self.dx is None:
+            d0 = self._errorNorm(self._y,self._y,self._y)
+            d1 = self._errorNorm(self._f,self._y,self._y)
+            self.dx = 1.e-6 if (d0 < 1.e-5 or d1 < 1.e-5) else 0.01*d0/d1
+
+    def dense(self,x):
+        '''Interpolates y at x, which should lie within the last step '''
+
+        if self._last is None:
+            print('Error: dense output needs a step')
+            return None
+        y = _hermite(x,*self._last)
+        return y[0] if self.scalar else y
+
+    def __call__(self,xEnd,nOut=None,xOut=None,curve=False):
+        '''
+        Integrates to xEnd, and returns the solution at the output
+        points xOut (default: nOut evenly spaced points from the
+        current x to xEnd, or just xEnd) as arrays x,y, or as a Curve
+        if curve is True. See the documentation of integrator.
+        '''
+
+        if xOut is None:
+            if nOut is None or nOut == 1:
+                xOut = np.array([xEnd],float)
+            elif nOut < 1:
+                print('Error: nOut must be at least 1')
+                return None
+            else:
+                xOut = np.linspace(self.x,xEnd,nOut)
+        else:
+            xOut = np.asarray(xOut,float)
+            xEnd = xOut[-1]
+        if np.min(xOut) < self.x:
+            print('Error: the output points must not be behind the current x')
+            return None
+        yOut = np.empty((len(xOut),)+np.shape(self.y))
+        i = 0
+        while i < len(xOut) and xOut[i] <= self.x:
+            yOut[i] = self.y
+            i += 1
+        self._firstStep()
+        while self.x < xEnd:
+            x0 = self.x
+            if self.x+1.0001*self.dx >= xEnd:
+                #Land the last step on xEnd
+                self.next(xEnd-self.x)
+            else:
+                self.next()
+            if self.x == x0:
+                #The step failed (step size underflow): return the
+                #output computed so far
+                xOut,yOut = xOut[:i],yOut[:i]
+                break
+            if self.x+1.e-12*abs(xEnd) >= xEnd:
+                self.x = xEnd
+            while i < len(xOut) and xOut[i] <= self.x:
+                yOut[i] = self.y if xOut[i] == self.x else self.dense(xOut[i])
+                i += 1
+        if not curve:
+            return xOut,yOut
+        return _trajectoryCurve(xOut,yOut)
 
 class newtSolve:
     '''
@@ -772,6 +3628,19 @@ class newtSolve:
 
     e.g. to change the maximum number of iterations for an instance
     of the class, set solver.nmax = 10 .
+
+    To solve the same equation many times (e.g. for the equilibrium
+    temperature at each latitude), use
+    x,converged = solver.batch(guesses,params)
+    where guesses is an array of initial guesses, and/or params an
+    array (or list) with one parameter value per root (a single guess
+    or params value is used for all of them; to use the same list for
+    all of them, put it in a Dummy object). f (and fp) then have to
+    accept arrays: they are called with an array of x and the
+    matching array of params, for the roots which haven't
+    converged yet. All the roots are iterated together, and batch
+    returns the array of roots, and a boolean array telling which
+    of them have converged.
     '''
 
     def __init__(self, f, fprime=None):
@@ -791,7 +3660,7 @@ class newtSolve:
         self.eps = 1.e-6
         def deriv(x,params):
             return (self.f(x+self.eps,params)- self.f(x-self.eps,params))/(2.*self.eps)
-        if fprime == None:
+        if fprime is None:
             self.deriv = deriv 
         else:
             #A derivative function was explicitly specified
@@ -812,7 +3681,7 @@ class newtSolve:
         self.params = None
         
     def __call__(self,xGuess,params = None):
-        if not (params == None):
+        if params is not None:
             self.setParams(params)
         x = xGuess
         for i in range(self.nmax):
@@ -821,7 +3690,43 @@ class newtSolve:
             if abs(dx) < self.tolerance:
                 return x
         return 'No Convergence'
-    
+
+    def batch(self,xGuess,params=None):
+        '''
+        Finds many roots at once, from an array of initial guesses
+        and/or an array of params, with the same shape (see the
+        class documentation). Returns the array of roots and a
+        boolean array, True where the iteration has converged.
+        '''
+
+        if params is None:
+            params = self.params
+        if type(params) in [type([]),type(())]:
+            params = np.asarray(params)
+        batchParams = isinstance(params,np.ndarray) and (params.ndim > 0)
+        shape = np.broadcast_shapes(np.shape(xGuess),params.shape) if batchParams \
+            else np.shape(xGuess)
+        x = np.array(np.broadcast_to(xGuess,shape),dtype=float).reshape(-1)
+        if batchParams:
+            params = np.broadcast_to(params,shape).reshape(-1)
+        converged = np.zeros(len(x),dtype=bool)
+        active = np.arange(len(x))
+        for i in range(self.nmax):
+            if len(active) == 0:
+                break
+            p = params[active] if batchParams else params
+            xa = x[active]
+            with np.errstate(divide='ignore',invalid='ignore'):
+                dx = self.f(xa,p)/self.deriv(xa,p)
+            #Roots which fail (e.g. with a zero derivative) keep their
+            #last value, and are dropped from the iteration
+            failed = ~np.isfinite(dx)
+            x[active] = np.where(failed,xa,xa-dx)
+            done = abs(dx) < self.tolerance
+            converged[active[done]] = True
+            active = active[~done & ~failed]
+        return x.reshape(shape),converged.reshape(shape)
+
     def setParams(self,params):
         #**ToDo: Check if f1 has a parameter argument
         #defined, and complain if it doesn't
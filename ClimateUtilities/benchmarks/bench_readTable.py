@@ -0,0 +1,105 @@
+'''
+Benchmark of the table reader: readTable, compared with the original,
+line-by-line implementation of clean/findData/scan (reproduced below).
+
+Usage
+-----
+    python bench_readTable.py [nrows]
+
+The default is 10 million rows, a plain numeric table (with a short
+description, and no blank lines among the data). The original
+implementation then needs a minute or so.
+
+License
+-------
+BSD 3-clause (see https://www.w3.org/Consortium/Legal/2008/03-bsd-license.html)
+'''
+
+import sys
+import os
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), r'..')))
+import ClimateUtilities as cu
+
+#----------- The original implementation, for comparison -------------
+def clean_orig(buff):
+    buff = [line.strip() for line in buff]
+    while(1):
+        try:
+            buff.remove('')
+        except:
+            break
+    return buff
+
+def findData_orig(buff):
+    runStarts = []
+    for i in range(len(buff)-1):
+        dn = abs(len(buff[i].split())-len(buff[i+1].split()))
+        if not dn==0:
+            runStarts.append(i+1)
+    runStarts.append(len(buff))
+    nmax = -1
+    for i in range(len(runStarts)-1):
+        n = runStarts[i+1]-runStarts[i]
+        if n > nmax:
+            nmax = n
+            imax = runStarts[i]
+    if nmax == -1:
+        nmax = len(buff)
+        imax = 0
+    return imax,imax+nmax
+
+def readTable_orig(filename):
+    buff = open(filename).readlines()
+    buff = clean_orig(buff)
+    startDataLine,endDataLine = findData_orig(buff)
+    header = buff[startDataLine].split()
+    varlist = [[] for i in range(len(header))]
+    for line in buff[(startDataLine+1):endDataLine]:
+        items = line.split()
+        for i in range(len(varlist)):
+            varlist[i].append(float(items[i]))
+    c = cu.Curve()
+    for i,key in enumerate(header):
+        c.addCurve(varlist[i],key)
+    return c
+
+#---------------------------------------------------------------------
+
+def make_table(fileName, nrows, blankEvery=None):
+    '''Writes a sounding-like table, with a description and a header,
+    and optionally a blank line after every blankEvery rows'''
+
+    rng = np.random.default_rng(0)
+    block = 100000
+    with open(fileName, 'w') as f:
+        f.write('Synthetic sounding\nfor benchmarking readTable\n\n')
+        f.write('p\tT\tq\tu\tv\n')
+        for i0 in range(0, nrows, block):
+            data = rng.standard_normal((min(block, nrows-i0), 5))
+            lines = ['%e\t%e\t%e\t%e\t%e'%tuple(row) for row in data]
+            if blankEvery:
+                for i in range(0, len(lines), blankEvery):
+                    lines[i] += '\n'
+            f.write('\n'.join(lines)+'\n')
+
+if __name__ == '__main__':
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    fileName = os.path.join(tempfile.gettempdir(), 'bench_readTable.txt')
+    make_table(fileName, nrows)
+
+    t0 = time.perf_counter()
+    c_new = cu.readTable(fileName)
+    t_new = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    c_orig = readTable_orig(fileName)
+    t_orig = time.perf_counter() - t0
+
+    same = all([np.array_equal(c_new[id], c_orig[id]) for id in c_orig.listVariables()])
+    print('%d rows: original %.2f s, readTable %.2f s, speedup %.1fx, identical: %s'%(
+        nrows, t_orig, t_new, t_orig/t_new, same))
+    os.remove(fileName)
@@ -0,0 +1,81 @@
+'''
+Benchmark of romberg on Planck-band integrals: the integrand evaluated
+one point at a time (vectorized=False, the original behavior) compared
+with all the new points of a refinement level in one call.
+
+Usage
+-----
+    python bench_romberg.py
+
+License
+-------
+BSD 3-clause (see https://www.w3.org/Consortium/Legal/2008/03-bsd-license.html)
+'''
+
+import sys
+import os
+import time
+import math
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), r'..')))
+import ClimateUtilities as cu
+
+#Physical constants (as in phys), so that the benchmark runs without scipy
+h = 6.62607015e-34
+c = 2.99792458e8
+k = 1.380649e-23
+
+def B(nu, T):
+    '''Planck function of frequency nu [Hz] at temperature T [K]'''
+    u = np.minimum(h*nu/(k*T), 500.)
+    return (2.*h/c**2)*nu**3/np.expm1(u)
+
+def B_scalar(nu, T):
+    '''The same, written with math, for scalar nu only'''
+    u = min(h*nu/(k*T), 500.)
+    return (2.*h/c**2)*nu**3/math.expm1(u)
+
+def B_lines(nu, T):
+    '''Planck function seen through a band of evenly spaced absorption
+    lines (Lorentz profiles of optical depth 5 at the line centers, 25
+    per 1/cm), which takes many refinement levels to resolve'''
+    nuLines = (nu/(100.*c)) % 25. - 12.5
+    return B(nu, T)*np.exp(-5./(1.+(nuLines/0.5)**2))
+
+def B_lines_scalar(nu, T):
+    nuLines = (nu/(100.*c)) % 25. - 12.5
+    return B_scalar(nu, T)*math.exp(-5./(1.+(nuLines/0.5)**2))
+
+#Wavenumber bands [1/cm], converted to frequency
+bands = [(10., 250.), (250., 500.), (500., 750.), (750., 1000.),
+         (1000., 1500.), (1500., 2500.)]
+temperatures = [200., 250., 300.]
+
+def run(f, vectorized, relTolerance):
+    '''Integrates f over all bands and temperatures. romberg's tolerance
+    is absolute, so it is scaled with the integral of B over the band.'''
+    results = []
+    nEval = 0
+    t0 = time.perf_counter()
+    for T in temperatures:
+        for nu1, nu2 in bands:
+            interval = [100.*c*nu1, 100.*c*nu2]
+            scale = (nu2-nu1)*100.*c*B(100.*c*(nu1+nu2)/2., T)
+            integral = cu.romberg(f, vectorized=vectorized)
+            results.append(integral(interval, T, relTolerance*scale))
+            nEval += integral.trap.n+1
+    return time.perf_counter() - t0, np.array(results), nEval
+
+if __name__ == '__main__':
+    for name, f, f_scalar in [('Planck bands', B, B_scalar),
+                              ('Planck bands with lines', B_lines, B_lines_scalar)]:
+        for relTolerance in [1.e-6, 1.e-10]:
+            t_scalar, r_scalar, nEval = run(f_scalar, False, relTolerance)
+            t_loop, r_loop, nEval = run(f, False, relTolerance)
+            t_vec, r_vec, nEval = run(f, None, relTolerance)
+            print('%s, tolerance %.0e (%d integrals, %d evaluations): '
+                  'math loop %.3f s, numpy loop %.3f s, vectorized %.4f s, '
+                  'speedup %.0fx (%.0fx over math), max rel. difference %.1e'%(
+                  name, relTolerance, len(r_vec), nEval, t_scalar, t_loop, t_vec,
+                  t_loop/t_vec, t_scalar/t_vec, np.max(abs(r_vec/r_loop-1.))))
@@ -0,0 +1,805 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), r'..')))
+
+import ClimateUtilities as cu
+import unittest
+import math
+import tempfile
+import gzip
+import bz2
+import numpy as np
+
+def write_table(text, suffix='.txt'):
+    '''Writes text to a temporary file, and returns the file name'''
+    fd, fileName = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    return fileName
+
+class TestReadTable(unittest.TestCase):
+    def setUp(self):
+        rows = ''.join(['%d %g %g\n'%(i, 0.5*i, 2.*i) for i in range(25)])
+        self.fileName = write_table('A sounding\nstation 42\n\np T q\n' + rows)
+        
+    def tearDown(self):
+        os.remove(self.fileName)
+        
+    def test_chunks(self):
+        chunks = list(cu.readTableChunks(self.fileName, chunkSize=10, nPrefix=8))
+        self.assertEqual([len(c['p']) for c in chunks], [10, 10, 5])
+        self.assertEqual(chunks[0].listVariables(), ['p', 'T', 'q'])
+        q = np.concatenate([c['q'] for c in chunks])
+        self.assertTrue(np.all(q == cu.readTable(self.fileName)['q']))
+
+        # A description longer than nPrefix lines
+        text = ''.join(['Line %d of a long description\n'%i for i in range(30)])
+        longFile = write_table(text + open(self.fileName).read())
+        chunks = list(cu.readTableChunks(longFile, chunkSize=10, nPrefix=8))
+        os.remove(longFile)
+        self.assertEqual(chunks[0].listVariables(), ['p', 'T', 'q'])
+        self.assertEqual([len(c['p']) for c in chunks], [10, 10, 5])
+        # Without any numbers, there's nothing to yield
+        textFile = write_table(text)
+        self.assertEqual(list(cu.readTableChunks(textFile, nPrefix=8)), [])
+        os.remove(textFile)
+        
+    def test_columnStore(self):
+        # By default X() and Y() are copies, which can be changed freely
+        c = cu.readTable(self.fileName)
+        x = c.X()
+        x -= 1000.
+        c.Y()[:] = 0.
+        self.assertEqual(list(c['p'][:3]), [0., 1., 2.])
+        self.assertEqual(list(c['T'][:3]), [0., 0.5, 1.])
+        # With a column store, they are views of the data
+        c = cu.readTable(self.fileName, columnStore=True)
+        self.assertTrue(np.shares_memory(c.Y(), c['q']))
+
+    def test_scan(self):
+        buff = ['Some header text', '', 'x y', '1 2', '3 4', '', '5 6', 'a b c']
+        data, header = cu.scan(buff)
+        self.assertEqual(header, ['x', 'y'])
+        self.assertEqual(list(data['y']), [2., 4., 6.])
+        self.assertTrue(data['x'].flags['C_CONTIGUOUS'])
+
+        # A line that can't be converted is skipped, as before
+        data, header = cu.scan(['x y', '1 2', 'z 4', '5 6'])
+        self.assertEqual(list(data['x']), [1., 5.])
+
+        # readTable parses whole files in one piece, with the same results
+        for text in ['Some header text\r\n\r\nx y\r\n1 2\r\n3 4\r\n \r\n5 6\r\na b c\r\n',
+                     'x,y\n1,2\n\n3,4\n5,6\n', 'x y\n1 2\nz 4\n5 6']:
+            fileName = write_table(text)
+            delimiter = ',' if ',' in text else None
+            c = cu.readTable(fileName, delimiter=delimiter)
+            data, header = cu.scan(text.splitlines(), delimiter=delimiter)
+            self.assertEqual(c.listVariables(), header)
+            for id in header:
+                self.assertEqual(list(c[id]), list(data[id]))
+            os.remove(fileName)
+
+    def test_missingCodes(self):
+        buff = ['z T q', '0 10 1', '1 - 2', '2 12 NA', '3 13 -999', '4 14 5']
+        data, header = cu.scan(buff, missingCodes=['-', 'NA', -999])
+        self.assertEqual(list(data['T'].mask), [False, True, False, False, False])
+        self.assertEqual(list(data['q'].mask), [False, False, True, True, False])
+
+        missingFile = write_table('\n'.join(buff))
+        c = cu.readTable(missingFile, missingCodes=['-', 'NA', -999], fill=True)
+        os.remove(missingFile)
+        self.assertFalse(np.ma.isMaskedArray(c['q']))
+        self.assertTrue(np.allclose(c.Y(), [[10, 11, 12, 13, 14], [1, 2, 3, 4, 5]]))
+
+    def test_sniffDelimiter(self):
+        csvFile = write_table('a,b\n1,2\n3,4\n5,6\n', suffix='.csv')
+        chunks = list(cu.readTableChunks(csvFile, chunkSize=2))
+        os.remove(csvFile)
+        self.assertEqual(chunks[0].listVariables(), ['a', 'b'])
+        self.assertEqual(list(chunks[1]['b']), [6.])
+        
+    def test_compressed(self):
+        text = open(self.fileName).read()
+        c = cu.readTable(self.fileName)
+        for module, suffix in [(gzip, '.gz'), (bz2, '.bz2')]:
+            fd, fileName = tempfile.mkstemp(suffix=suffix)
+            os.close(fd)
+            with module.open(fileName, 'wt') as f:
+                f.write(text)
+            cz = cu.readTable(fileName, missingCodes=['-'])
+            chunks = list(cu.readTableChunks(fileName, chunkSize=10))
+            os.remove(fileName)
+            self.assertEqual(cz.listVariables(), ['p', 'T', 'q'])
+            self.assertTrue(np.all(cz['q'] == c['q']))
+            self.assertEqual([len(chunk['p']) for chunk in chunks], [10, 10, 5])
+
+        # Unreadable entries give the same (uneven) columns either way
+        text = 'p T q\n' + ''.join(['%d %d %d\n'%(i, i, i) for i in range(20)])
+        text = text.replace('3 3 3', '3 x 3').replace('12 12 12', '12 12 x')
+        plain = write_table(text)
+        fd, fileName = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        with gzip.open(fileName, 'wt') as f:
+            f.write(text)
+        chunkSize = cu._readChunkSize
+        cu._readChunkSize = 7
+        try:
+            c, cz = cu.readTable(plain), cu.readTable(fileName)
+        finally:
+            cu._readChunkSize = chunkSize
+            os.remove(plain)
+            os.remove(fileName)
+        self.assertEqual([len(c[id]) for id in 'pTq'], [20, 19, 18])
+        for id in 'pTq':
+            self.assertTrue(np.array_equal(cz[id], c[id]))
+
+    def test_readTables(self):
+        badFile = write_table('')
+        other = write_table('p T\n' + ''.join(['%d %d\n'%(i, -i) for i in range(5)]))
+        paths = [self.fileName, badFile, other]
+        for workers in [1, 2]:
+            curves, errors = cu.readTables(paths, workers=workers)
+            self.assertEqual(list(curves.keys()), [self.fileName, other])
+            self.assertEqual(list(errors.keys()), [badFile])
+            self.assertEqual(list(curves[other]['T']), [0., -1., -2., -3., -4.])
+
+        c, errors = cu.readTables(paths, workers=1, concatenate=True)
+        os.remove(badFile)
+        os.remove(other)
+        self.assertEqual(list(errors.keys()), [badFile, other])
+        self.assertEqual(c.listVariables(), ['p', 'T', 'q', 'file'])
+        self.assertEqual(len(c['file']), 25)
+
+    def test_readTablesMalformed(self):
+        # A bad data line leaves columns of different lengths, as in readTable
+        malformed = write_table('x y z\n1 2 3\n4 5 6\n7 abc 9\n9 10 11\n')
+        for workers in [1, 2]:
+            curves, errors = cu.readTables([malformed], workers=workers)
+            self.assertEqual(errors, {})
+            c = cu.readTable(malformed)
+            for id in ['x', 'y', 'z']:
+                self.assertEqual(list(curves[malformed][id]), list(c[id]))
+        os.remove(malformed)
+
+class TestCurve(unittest.TestCase):
+    def setUp(self):
+        self.c = cu.Curve()
+        self.c.addCurve(np.arange(5.), 'p', 'pressure')
+        self.c.addCurve(np.ma.masked_greater(np.arange(5.)**2, 10.), 'T')
+        self.c.description = 'A test curve'
+        self.c.reverseY = 1
+
+    def test_save(self):
+        fd, fileName = tempfile.mkstemp(suffix='.cuc')
+        os.close(fd)
+        self.c.save(fileName)
+        c = cu.loadCurve(fileName)
+        self.assertTrue(isinstance(c['p'], np.memmap))
+        self.assertEqual(c.listVariables(), ['p', 'T'])
+        self.assertEqual(c.label['p'], 'pressure')
+        self.assertEqual(c.description, 'A test curve')
+        self.assertEqual(c.reverseY, 1)
+        self.assertEqual(list(c['T'].mask), [False]*4 + [True])
+        # The file is opened read-only, but columns can still be replaced
+        p = c['p']
+        c['p'] = p*100.
+        self.assertEqual(list(p), [0., 1., 2., 3., 4.])
+        self.assertEqual(list(c['p']), [0., 100., 200., 300., 400.])
+        # A mapped Curve can be saved back to its own file
+        c = cu.loadCurve(fileName, mode='c')
+        c.save(fileName)
+        self.assertEqual(list(cu.loadCurve(fileName)['p']), [0., 1., 2., 3., 4.])
+        # A Curve which can't be saved leaves the file alone
+        c.addCurve(np.arange(3.), 'short')
+        size = os.path.getsize(fileName)
+        self.assertEqual(c.save(fileName), None)
+        self.assertEqual(os.path.getsize(fileName), size)
+        del c, p
+        os.remove(fileName)
+
+    def test_dump(self):
+        fd, fileName = tempfile.mkstemp(suffix='.csv.gz')
+        os.close(fd)
+        self.c.dump(fileName, format='csv')
+        lines = gzip.open(fileName, 'rt').read().splitlines()
+        self.assertEqual(lines[:3], ['A test curve', 'p,T', '0.000000e+00,0.000000e+00'])
+        self.assertEqual(len(lines), 7)
+        os.remove(fileName)
+        # An unknown compression is reported, and nothing is written
+        self.assertEqual(self.c.dump(fileName, compression='zip'), None)
+        self.assertFalse(os.path.exists(fileName))
+
+        # So is an unknown format, without emptying an existing file
+        fileName = write_table('keep me\n')
+        self.assertEqual(self.c.dump(fileName, format='xml'), None)
+        self.assertEqual(self.c.dump(fileName, compression='zip'), None)
+        self.assertEqual(open(fileName).read(), 'keep me\n')
+        os.remove(fileName)
+
+        # Masked entries are written as missingCode, and can be read back
+        self.c['T'] = np.ma.MaskedArray(self.c['T'], mask=[0, 1, 0, 0, 1])
+        fileName = write_table('')
+        for format, delimiter in [('text', None), ('csv', ','), ('fixed', None)]:
+            self.c.dump(fileName, format=format, compression='', missingCode='-')
+            c = cu.readTable(fileName, delimiter=delimiter, missingCodes=['-'])
+            self.assertEqual(list(np.ma.getmaskarray(c['T'])), [False, True, False, False, True])
+            self.assertTrue(np.all(c['T'] == self.c['T']))
+        os.remove(fileName)
+
+    def test_columnStore(self):
+        c = cu.Curve(columnStore=True)
+        for i in range(6):
+            c.addCurve(np.arange(4.)*i, 'v%d'%i)
+        y = c.Y()
+        self.assertEqual(y.shape, (5, 4))
+        self.assertTrue(np.shares_memory(y, c['v1']))
+        self.assertTrue(c.Y() is y)
+
+        # Changing the data invalidates the cached results
+        c['v2'] = [1, 1, 1, 1]
+        self.assertEqual(list(c.Y()[1]), [1., 1., 1., 1.])
+        c.Xid = 'v3'
+        self.assertEqual(list(c.X()), [0., 3., 6., 9.])
+        self.assertEqual(c.Y().shape, (5, 4))
+
+        # Replacing a column leaves arrays from before alone
+        v4 = c['v4']
+        c['v4'] = v4 - 273.15
+        self.assertEqual(list(v4), [0., 4., 8., 12.])
+        self.assertEqual(list(c['v4']), [-273.15, -269.15, -265.15, -261.15])
+        self.assertTrue(np.shares_memory(c.Y(), c['v4']))
+
+        # Only the replaced column is copied, the others stay in the store
+        store = c._store
+        c['v5'] = c['v5']*2.
+        self.assertEqual(list(c['v5']), [0., 10., 20., 30.])
+        self.assertFalse(np.shares_memory(c['v5'], store))
+        for id in ['v0', 'v1', 'v2', 'v3', 'v4']:
+            self.assertTrue(np.shares_memory(c[id], store))
+        self.assertEqual(list(c.Y()[-1]), [0., 10., 20., 30.])
+        c.addCurve(np.ones(4), 'v6')
+        self.assertEqual(list(c['v5']), [0., 10., 20., 30.])
+
+    def test_copies(self):
+        # Without a column store, X() and Y() return copies of the data
+        x = self.c.X()
+        x -= 273.15
+        self.assertEqual(list(self.c['p']), [0., 1., 2., 3., 4.])
+        self.assertFalse(np.shares_memory(self.c.Y(), self.c['T']))
+        # Curves can carry attributes of their own
+        self.c.units = 'hPa'
+        self.assertEqual(self.c.units, 'hPa')
+
+    def test_slice(self):
+        c = cu.Curve()
+        c.addCurve(np.linspace(1000., 100., 10), 'p', 'pressure')
+        c.addCurve(np.arange(10.), 'T')
+        c.reverseY = 1
+        band = c.slice(300., 650.)
+        self.assertEqual(list(band['p']), [600., 500., 400., 300.])
+        self.assertTrue(np.shares_memory(band['T'], c['T']))
+        self.assertEqual(band.reverseY, 1)
+        self.assertEqual(band.label['p'], 'pressure')
+        self.assertEqual(c.at(420.)['T'], 6.)
+
+        # Unsorted X: the rows are copied, in their original order
+        c = cu.Curve()
+        c.addCurve([3., 1., 2., 5., 4.], 'x')
+        c.addCurve([0., 1., 2., 3., 4.], 'y')
+        self.assertEqual(list(c.slice(2., 4.)['y']), [0., 2., 4.])
+        self.assertEqual(c.at(4.4)['y'], 4.)
+
+        # Changes of X in place are seen by the next call
+        c['x'][0] = 4.2
+        self.assertEqual(c.at(4.2)['y'], 0.)
+
+    def test_appendRows(self):
+        c = cu.Curve()
+        for i in range(100):
+            c.appendRow({'t': 0.1*i, 'y': float(i)})
+        self.assertEqual(c.listVariables(), ['t', 'y'])
+        self.assertEqual(len(c['y']), 100)
+        self.assertTrue(np.shares_memory(c.Y(), c['y']))
+        c.appendRows([[20., 200.], [30., 300.]])
+        self.assertEqual(list(c.X()[-3:]), [9.9, 20., 30.])
+
+        # Masked columns keep their masks
+        self.c.appendRows({'p': [5., 6.], 'T': [25., 36.]})
+        self.assertEqual(list(self.c['T'].mask), [False]*4 + [True, False, False])
+        # The masks grow with the store, instead of being copied at each row
+        mask = self.c['T'].mask
+        self.c.appendRow({'p': 7., 'T': 49.})
+        self.assertTrue(np.shares_memory(self.c['T'].mask, mask))
+        for i in range(100):
+            self.c.appendRow({'p': 8., 'T': 64.})
+        self.assertEqual(list(self.c['T'].mask[:6]), [False]*4 + [True, False])
+        self.assertFalse(self.c['T'].mask[6:].any())
+
+    def test_appendRowsErrors(self):
+        c = cu.Curve()
+        c.addCurve(np.arange(3.), 'a')
+        c.addCurve(np.arange(3.), 'b')
+        # Blocks of different lengths, and unknown columns, are not appended
+        self.assertEqual(c.appendRows({'a': [1., 2., 3.], 'b': [1.]}), None)
+        self.assertEqual(c.appendRows({'a': [1.], 'b': [1.], 'c': [1.]}), None)
+        self.assertEqual(len(c['b']), 3)
+        # A non-numeric column is found before the Curve is changed
+        c.addCurve(['x', 'y', 'z'], 'name')
+        self.assertEqual(c.appendRow([1., 2., 3.]), None)
+        self.assertTrue(c._store is None)
+        self.assertEqual(c._slot, {})
+
+        # A state vector, as from an integrator, goes into several columns
+        c = cu.Curve()
+        c.appendRow(np.append(0.5, np.array([1., 2.])))
+        self.assertEqual(c.listVariables(), ['v0', 'v1', 'v2'])
+        self.assertEqual(c.appendRow({'v0': 1., 'v1': np.array([1., 2.]), 'v2': 3.}), None)
+        self.assertEqual(len(c['v1']), 1)
+
+class TestInterp(unittest.TestCase):
+    def test_arrays(self):
+        xa = np.linspace(1000., 100., 20)
+        f = cu.interp(xa, np.log(xa))
+        x = np.linspace(50., 1050., 101)
+        y = f(x)
+        self.assertEqual(y.shape, x.shape)
+        self.assertTrue(np.allclose(y, [f(xi) for xi in x], rtol=1e-14))
+        xa = [0., 0.3, 0.7, 1.]
+        ya = [1., 2., 0., 3.]
+        self.assertTrue(np.allclose(cu.polint(xa, ya, x), [cu.polint(xa, ya, xi) for xi in x], rtol=1e-14))
+
+    def test_kinds(self):
+        xa = np.linspace(1000., 100., 20)
+        ya = np.log(xa)
+        x = np.linspace(50., 1050., 101)
+        f = cu.interp(xa, ya)
+        for n in [2, 4]:
+            g = cu.interp(xa, ya, n, kind='poly')
+            self.assertTrue(np.allclose(g(x), cu.interp(xa, ya, n)(x), rtol=1e-12))
+        self.assertAlmostEqual(cu.interp(xa, ya, kind='poly')(333.), f(333.), places=12)
+        for kind in ['cubic', 'monotone']:
+            g = cu.interp(xa, ya, kind=kind)
+            self.assertTrue(np.allclose(g(xa), ya))
+            self.assertTrue(np.allclose(g(x[5:-5]), np.log(x[5:-5]), atol=2e-2))
+
+        # The monotone kind doesn't overshoot a step
+        g = cu.interp([0., 1., 2., 3.], [0., 0., 1., 1.], kind='monotone')
+        y = g(np.linspace(0., 3., 31))
+        self.assertTrue(np.all(np.diff(y) >= 0) and y.min() >= 0. and y.max() <= 1.)
+
+        # Lists of points, also for a decreasing table
+        for kind in ['neville', 'poly', 'cubic', 'monotone']:
+            g = cu.interp(xa, ya, kind=kind)
+            self.assertTrue(np.allclose(g([333., 555.]), g(np.array([333., 555.]))))
+
+        # A one-point table is constant for every kind
+        for kind in ['neville', 'poly', 'cubic', 'monotone']:
+            g = cu.interp([1.], [3.], kind=kind)
+            self.assertEqual(g(2.), 3.)
+            self.assertTrue(np.allclose(g([0., 5.]), 3.))
+
+class TestRomberg(unittest.TestCase):
+    def test_vectorized(self):
+        exact = 1. - math.exp(-2.)
+        for f, vectorized in [(lambda x: math.exp(-x), False), (lambda x: np.exp(-x), True)]:
+            integral = cu.romberg(f)
+            self.assertAlmostEqual(integral([0., 2.], tolerance=1.e-10), exact, places=9)
+            self.assertEqual(integral.trap.vectorized, vectorized)
+
+        # Telling romberg that f only takes scalars skips the test call
+        calls = []
+        def g(x, T):
+            calls.append(x)
+            return T*x
+        self.assertAlmostEqual(cu.romberg(g, vectorized=False)([0., 1.], 2.), 1.)
+        self.assertTrue(all([np.ndim(x) == 0 for x in calls]))
+
+    def test_fullOutput(self):
+        integral = cu.romberg(lambda x: math.sqrt(x))
+        value, error, nEval = integral([0., 1.], tolerance=1.e-8, fullOutput=True)
+        self.assertAlmostEqual(value, 2./3., places=7)
+        self.assertEqual(nEval, integral.nList[-1] + 1)
+        self.assertEqual(error, integral.errorList[-1])
+        self.assertTrue(error <= 1.e-8 < integral.errorList[-2])
+
+        # The tableau gives the same result as extrapolating with polint
+        dx = [1./n**2 for n in integral.nList]
+        self.assertAlmostEqual(value, cu.polint(dx, integral.integralList, 0.), places=12)
+
+    def test_cache(self):
+        calls = []
+        def f(x, T):
+            calls.append(x)
+            return T*math.sqrt(x)
+        fresh = [cu.romberg(f, vectorized=False)([0., 1.], 2., tol) for tol in [1.e-4, 1.e-7, 1.e-3]]
+        nFresh = len(calls)
+        del calls[:]
+        integral = cu.romberg(f, vectorized=False, cacheSize=2)
+        resumed = [integral([0., 1.], 2., tol) for tol in [1.e-4, 1.e-7, 1.e-3]]
+        self.assertEqual(resumed, fresh)
+        # Only the evaluations of the most accurate integral were needed
+        self.assertEqual(len(calls), integral.nEval)
+        self.assertTrue(len(calls) < nFresh)
+
+        # Least recently used integrations are dropped
+        integral([0., 2.], 2.)
+        integral([0., 3.], 2.)
+        self.assertEqual(list(integral.cache.keys()), [(0., 2., 1., 2.), (0., 3., 1., 2.)])
+
+    def test_batch(self):
+        def f(x, T):
+            return x**3/np.expm1(x/T)
+        integral = cu.romberg(f)
+        T = np.array([0.5, 1., 2.])
+        values, errors, nEval = integral.batch([1., 4.], T, 1.e-9, fullOutput=True)
+        for i in range(len(T)):
+            self.assertAlmostEqual(values[i], integral([1., 4.], T[i], 1.e-9), places=12)
+            self.assertEqual(nEval[i], integral.nEval)
+        self.assertTrue(np.all(errors <= 1.e-9))
+
+        intervals = [[0., 1.], [0., 2.], [1., 3.]]
+        values = cu.romberg(lambda x: x**2).batch(intervals)
+        self.assertTrue(np.allclose(values, [1./3., 8./3., 26./3.]))
+        # params as a list
+        values = cu.romberg(lambda x, a: a*x).batch([0., 1.], [1., 2., 3.])
+        self.assertTrue(np.allclose(values, [0.5, 1., 1.5]))
+
+    def test_infinite(self):
+        integral = cu.romberg(lambda x: np.exp(-abs(x)))
+        self.assertAlmostEqual(integral([0., np.inf], tolerance=1.e-10), 1., places=10)
+        self.assertAlmostEqual(integral([np.inf, 0.], tolerance=1.e-10), -1., places=10)
+        self.assertAlmostEqual(integral([-np.inf, np.inf], tolerance=1.e-10), 2., places=10)
+        # Planck function of frequency, scaled by kT/h
+        def planck(u):
+            return u**3/math.expm1(u) if 0. < u < 700. else 0.
+        value = cu.romberg(planck)([0., np.inf], tolerance=1.e-8, scale=3.)
+        self.assertAlmostEqual(value, math.pi**4/15., places=7)
+        # Same in a batch, mixed with a finite interval
+        intervals = [[0., np.inf], [np.inf, 0.], [-np.inf, np.inf], [-np.inf, 0.], [0., 1.]]
+        values = integral.batch(intervals, tolerance=1.e-10)
+        self.assertTrue(np.allclose(values, [1., -1., 2., 1., 1. - math.exp(-1.)], atol=1.e-9))
+        values = cu.romberg(lambda x, a: np.exp(-a*x)).batch([0., np.inf], [1., 2.], scale=2.)
+        self.assertTrue(np.allclose(values, [1., 0.5]))
+
+class TestGaussKronrod(unittest.TestCase):
+    def test_rules(self):
+        # The Kronrod rules integrate polynomials of degree 3n+1 exactly,
+        # and the Gauss rules those of degree 2n-1, so that no
+        # subdivision is needed then
+        for rule, degree, gaussDegree in [(15, 22, 12), (21, 30, 18)]:
+            integral = cu.gaussKronrod(lambda x: x**degree, rule)
+            self.assertAlmostEqual(np.dot(integral.nodes**degree, integral.kronrod), 2./(degree+1), places=14)
+            integral = cu.gaussKronrod(lambda x: x**gaussDegree + x, rule)
+            value, error, nEval = integral([-1., 1.], fullOutput=True)
+            self.assertAlmostEqual(value, 2./(gaussDegree+1), places=14)
+            self.assertEqual(nEval, rule)
+
+    def test_adaptive(self):
+        # A sharp peak, and an endpoint singularity
+        peak = cu.gaussKronrod(lambda x, w: np.exp(-((x-0.3)/w)**2))
+        value = peak([0., 1.], 0.001, tolerance=1.e-10)
+        self.assertAlmostEqual(value, math.sqrt(math.pi)*0.001, places=12)
+        self.assertTrue(peak.error < 1.e-10 and peak.nEval < 1000)
+        singular = cu.gaussKronrod(lambda x: 1./math.sqrt(x), rule=21)
+        self.assertAlmostEqual(singular([0., 1.], tolerance=1.e-9), 2., places=8)
+        self.assertFalse(singular.vectorized)
+
+    def test_infinite(self):
+        integral = cu.gaussKronrod(lambda x: np.exp(-x*x))
+        value = integral([-np.inf, np.inf], tolerance=1.e-10)
+        self.assertAlmostEqual(value, math.sqrt(math.pi), places=12)
+        value = integral([1., np.inf], tolerance=1.e-10)
+        self.assertAlmostEqual(value, math.sqrt(math.pi)*math.erfc(1.)/2., places=12)
+
+class TestIntegrator(unittest.TestCase):
+    def test_dopri5(self):
+        def g(t, z):
+            return np.array([z[1], -z[0]])
+        m = cu.integrator(g, 0., np.array([1., 0.]), method='dopri5', rtol=1.e-8, atol=1.e-10)
+        nSteps = 0
+        while m.x < 10.:
+            m.next()
+            nSteps += 1
+        self.assertTrue(np.allclose(m.y, [math.cos(m.x), -math.sin(m.x)], atol=1.e-7))
+        self.assertTrue(nSteps < 200)
+        # Dense output within the last step
+        x = m.x - 0.3*m._dense[1]
+        self.assertTrue(np.allclose(m.dense(x), [math.cos(x), -math.sin(x)], atol=1.e-7))
+
+        # Changes of m.y in place are used in the next step
+        m = cu.integrator(g, 0., np.array([1., 0.]), method='dopri5', rtol=1.e-3)
+        for i in range(3):
+            m.next()
+        x0 = m.x
+        m.y[0] += 1.
+        z0 = m.y.copy()
+        m.next()
+        dx = m.x - x0
+        exact = [z0[0]*math.cos(dx) + z0[1]*math.sin(dx), z0[1]*math.cos(dx) - z0[0]*math.sin(dx)]
+        self.assertTrue(np.allclose(m.y, exact, atol=1.e-7))
+
+        # Scalar problems, with parameters
+        m = cu.integrator(lambda t, z, a: -a*z, 0., 1., method='dopri5')
+        m.setParams(2.)
+        while m.x < 1.:
+            m.next()
+        self.assertAlmostEqual(m.y, math.exp(-2.*m.x), places=6)
+
+    def test_ensemble(self):
+        # Oscillators with frequencies 1 to 8, one per row
+        def g(t, z, w):
+            return np.stack([w*z[:, 1], -w*z[:, 0]], axis=1)
+        w = np.arange(1., 9.)
+        start = np.stack([np.ones(8), np.zeros(8)], axis=1)
+
+        m = cu.integrator(g, 0., start, .001)
+        m.setParams(w)
+        for i in range(1000):
+            m.next()
+        exact = np.stack([np.cos(w*m.x), -np.sin(w*m.x)], axis=1)
+        self.assertTrue(np.allclose(m.y, exact, atol=1.e-6))
+
+        m = cu.integrator(g, 0., start, method='dopri5', rtol=1.e-8, atol=1.e-10)
+        m.setParams(w)
+        while m.x < 2.:
+            m.next()
+        exact = np.stack([np.cos(w*m.x), -np.sin(w*m.x)], axis=1)
+        self.assertTrue(np.allclose(m.y, exact, atol=1.e-6))
+
+        m = cu.integrator(g, 0., start, method='dopri5', rtol=1.e-8, atol=1.e-10,
+                          stepControl='member')
+        m.setParams(w)
+        while m.x.min() < 2.:
+            m.next()
+        self.assertEqual(m.x.shape, (8,))
+        exact = np.stack([np.cos(w*m.x), -np.sin(w*m.x)], axis=1)
+        self.assertTrue(np.allclose(m.y, exact, atol=1.e-6))
+        # The slow oscillators take longer steps
+        self.assertTrue(m.dx[0] > 2.*m.dx[-1])
+
+    def test_trajectory(self):
+        def g(t, z):
+            return np.array([z[1], -z[0]])
+        for method in ['rk4', 'dopri5']:
+            m = cu.integrator(g, 0., np.array([1., 0.]), .01, method=method,
+                              rtol=1.e-9, atol=1.e-12)
+            x, y = m(10., nOut=101)
+            self.assertEqual(y.shape, (101, 2))
+            self.assertEqual(m.x, 10.)
+            exact = np.stack([np.cos(x), -np.sin(x)], axis=1)
+            self.assertTrue(np.allclose(y, exact, atol=1.e-7))
+            # Same object, from the start again, as a Curve
+            m.reset()
+            self.assertEqual(m.x, 0.)
+            c = m(3., xOut=[0., 1., 2.5, 3.], curve=True)
+            self.assertTrue(np.allclose(c['y0'], np.cos(c['x']), atol=1.e-7))
+            self.assertTrue(np.allclose(c['y1'], -np.sin(c['x']), atol=1.e-7))
+            # nOut=1 gives the end point
+            m.reset()
+            x, y = m(1., nOut=1)
+            self.assertEqual(list(x), [1.])
+            self.assertEqual(m.x, 1.)
+            self.assertTrue(np.allclose(y[0], [math.cos(1.), -math.sin(1.)], atol=1.e-7))
+            # Output points very close to each other are all reached
+            m.reset()
+            x, y = m(1., xOut=[0.5, 0.5 + 1.e-7, 1.])
+            self.assertTrue(np.allclose(y[1], [math.cos(x[1]), -math.sin(x[1])], atol=1.e-7))
+            self.assertFalse(np.array_equal(y[0], y[1]))
+
+        # The rk4 trajectory takes the same steps as next()
+        m = cu.integrator(g, 0., np.array([1., 0.]), .01)
+        x, y = m(1.)
+        m.reset(np.array([1., 0.]))
+        for i in range(100):
+            m.next()
+        self.assertTrue(np.allclose(m.y, y[-1], rtol=1.e-12))
+
+        # Ensemble members with their own steps
+        def h(t, z, w):
+            return np.stack([w*z[:, 1], -w*z[:, 0]], axis=1)
+        w = np.arange(1., 5.)
+        m = cu.integrator(h, 0., np.stack([np.ones(4), np.zeros(4)], axis=1),
+                          method='dopri5', rtol=1.e-9, atol=1.e-12, stepControl='member')
+        m.setParams(w)
+        x, y = m(2., nOut=11)
+        self.assertTrue(np.all(m.x == 2.))
+        self.assertTrue(np.allclose(y[:, :, 0], np.cos(np.outer(x, w)), atol=1.e-7))
+
+    def test_inPlace(self):
+        def g(t, z, a):
+            return np.array([z[1], -a*z[0]])
+        def gInPlace(t, z, a, out):
+            out[0] = z[1]
+            out[1] = -a*z[0]
+        m = cu.integrator(g, 0., np.array([1., 0.]), .01)
+        mInPlace = cu.integrator(gInPlace, 0., np.array([1., 0.]), .01)
+        m.setParams(4.)
+        mInPlace.setParams(4.)
+        y = mInPlace.y
+        for i in range(200):
+            m.next()
+            mInPlace.next()
+        # Same steps, with y updated in place
+        self.assertTrue(mInPlace.y is y)
+        self.assertTrue(np.allclose(mInPlace.y, m.y, rtol=1.e-12))
+        self.assertAlmostEqual(mInPlace.x, m.x)
+        x, y = mInPlace(4., nOut=3)
+        self.assertTrue(np.allclose(y[-1], [math.cos(8.), -2.*math.sin(8.)], atol=1.e-6))
+
+        m = cu.integrator(gInPlace, 0., np.array([1., 0.]), method='dopri5')
+        m.setParams(4.)
+        x, y = m(4.)
+        self.assertTrue(np.allclose(y[-1], [math.cos(8.), -2.*math.sin(8.)], atol=1.e-4))
+
+    def test_events(self):
+        def g(t, z):
+            return np.array([z[1], -z[0]])
+        for method, tol in [('rk4', 1.e-5), ('dopri5', 1.e-8)]:
+            m = cu.integrator(g, 0., np.array([1., 0.]), .1, method=method,
+                              rtol=1.e-10, atol=1.e-12)
+            m.addEvent(lambda t, z: z[1])
+            m.addEvent(lambda t, z: z[0] - 0.5, terminal=True, direction=1)
+            x, y = m(20., nOut=201)
+            # Stopped at cos(t) = 0.5 on the way up, after the zero of sin(t) at pi
+            xStop = 2.*math.pi - math.pi/3.
+            self.assertTrue(m.terminated)
+            self.assertEqual([e[2] for e in m.events], [0, 1])
+            self.assertAlmostEqual(m.events[0][0], math.pi, delta=tol)
+            self.assertAlmostEqual(m.x, xStop, delta=tol)
+            self.assertEqual(x[-1], m.x)
+            self.assertTrue(x[-2] < m.x)
+            self.assertTrue(np.allclose(y[-1], [0.5, -math.sin(xStop)], atol=tol))
+
+        # Falling from rest: next() stops at the ground
+        m = cu.integrator(lambda t, z, g: np.array([z[1], -g]), 0., np.array([10., 0.]), .1)
+        m.setParams(9.81)
+        m.addEvent(lambda t, z: z[0], terminal=True)
+        while not m.terminated:
+            m.next()
+        self.assertAlmostEqual(m.x, math.sqrt(20./9.81), places=10)
+
+        # Events later in the step that stopped are found after resuming
+        for method in ['rk4', 'dopri5']:
+            m = cu.integrator(lambda t, z: 1., 0., 0., 1., method=method)
+            m.addEvent(lambda t, z: z - 0.3, terminal=True)
+            m.addEvent(lambda t, z: z - 0.6)
+            m.next()
+            self.assertAlmostEqual(m.x, 0.3)
+            m(3.3)
+            self.assertEqual([e[2] for e in m.events], [0, 1])
+            self.assertAlmostEqual(m.events[1][0], 0.6)
+
+    def test_failures(self):
+        # Blows up at x = 1: stops there instead of looping forever
+        x, y = cu.integrator(lambda t, y: y*y, 0., 1., method='dopri5')(2., nOut=5)
+        self.assertEqual(len(x), 3)
+        self.assertTrue(np.allclose(y[:2], 1./(1. - x[:2])))
+        m = cu.integrator(lambda t, y: y*y, 0., np.array([[1.], [.2]]), method='dopri5',
+                          stepControl='member')
+        x, y = m(2., nOut=5)
+        # The member which blows up is stopped, and the other one goes on
+        self.assertEqual(len(x), 5)
+        self.assertEqual(list(m.failed), [True, False])
+        self.assertTrue(np.all(np.isnan(y[3:, 0, 0])))
+        self.assertTrue(np.allclose(y[:, 1, 0], .2/(1. - .2*x)))
+        self.assertTrue(m.x[0] < 1.01)
+        # Also with next(): the other member still moves on
+        m.reset(np.array([[1.], [.05]]))
+        self.assertEqual(list(m.failed), [False, False])
+        while not m.failed[0]:
+            m.next()
+        x1 = m.x[1]
+        m.next()
+        self.assertTrue(m.x[1] > x1)
+        self.assertFalse(m.failed[1])
+        # Output points behind the current x
+        for method in ['rk4', 'dopri5']:
+            m = cu.integrator(lambda t, y: -y, 1., 1., .1, method=method)
+            self.assertEqual(m(0.), None)
+            self.assertEqual(m(2., xOut=[.5, 2.]), None)
+            self.assertEqual(m.x, 1.)
+        self.assertEqual(cu.integrator(lambda t, y: -y, 0., 1., -.1)(1.), None)
+
+        # Reset to an ensemble of another size
+        m = cu.integrator(lambda t, y: -y, 0., np.ones((3, 1)), method='dopri5',
+                          stepControl='member')
+        m(1.)
+        m.reset(np.ones((5, 1)))
+        self.assertEqual(m.x.shape, (5,))
+        x, y = m(1.)
+        self.assertTrue(np.allclose(y[-1], math.exp(-1.)))
+
+class TestStiffIntegrator(unittest.TestCase):
+    def test_robertson(self):
+        def g(t, y):
+            return np.array([-0.04*y[0] + 1.e4*y[1]*y[2],
+                             0.04*y[0] - 1.e4*y[1]*y[2] - 3.e7*y[1]**2,
+                             3.e7*y[1]**2])
+        m = cu.stiffIntegrator(g, 0., np.array([1., 0., 0.]), rtol=1.e-5, atol=1.e-10,
+                               autonomous=True)
+        x, y = m(40.)
+        self.assertEqual(m.x, 40.)
+        self.assertTrue(np.allclose(y[-1], [0.7158271, 9.185535e-6, 0.2841637], rtol=1.e-4))
+        # The Jacobian is reused over many steps
+        self.assertTrue(2*m.nJac < m.nLU)
+
+    def test_banded(self):
+        n = 100
+        def g(t, T, k):
+            Tp = np.concatenate([[1.], T, [0.]])
+            return k*(Tp[2:] - 2.*T + Tp[:-2])*n**2 - (T - 0.5)
+        results = []
+        for bandwidth in [None, (1, 1)]:
+            m = cu.stiffIntegrator(g, 0., np.zeros(n), bandwidth=bandwidth, autonomous=True)
+            m.setParams(1.)
+            x, y = m(1., nOut=3)
+            results.append((y, m.nEval))
+        self.assertTrue(np.allclose(results[0][0], results[1][0], atol=1.e-10))
+        self.assertTrue(results[1][1] < results[0][1])
+
+    def test_scalar(self):
+        m = cu.stiffIntegrator(lambda t, y, a: -a*(y - math.cos(t)), 0., 0.,
+                               jac=lambda t, y, a: [[-a]])
+        m.setParams(1.e6)
+        x, y = m(2., nOut=5)
+        self.assertTrue(np.allclose(y[1:], np.cos(x[1:]), atol=1.e-5))
+        self.assertTrue(isinstance(m.y, float))
+
+    def test_setY(self):
+        # A new y, or a change of y in place, is used in the next step
+        m = cu.stiffIntegrator(lambda t, y: -y, 0., np.array([1., 2.]))
+        m.next(0.1)
+        m.y = np.array([10., 2.])
+        x0 = m.x
+        m.next(0.1)
+        self.assertAlmostEqual(m.y[0], 10.*math.exp(x0 - m.x), places=4)
+        m.y[1] = 5.
+        x0 = m.x
+        m.next(0.1)
+        self.assertAlmostEqual(m.y[1], 5.*math.exp(x0 - m.x), places=4)
+
+    def test_dense(self):
+        # Output between the steps comes from the Hermite interpolation
+        m = cu.stiffIntegrator(lambda t, y: -y, 0., 1.)
+        x, y = m(1., nOut=101)
+        self.assertTrue(np.allclose(y, np.exp(-x), rtol=0., atol=2.e-5))
+        m.reset()
+        for i in range(5):
+            m.next()
+        # Midpoint of the last step, against the exact solution from its start
+        x0, h, y0 = m._last[:3]
+        self.assertTrue(h > 0.01)
+        self.assertAlmostEqual(m.dense(x0 + 0.5*h), y0[0]*math.exp(-0.5*h), delta=1.e-6)
+
+    def test_failures(self):
+        # Blows up at x = 1: stops there instead of looping forever
+        x, y = cu.stiffIntegrator(lambda t, y: y*y, 0., 1.)(2., nOut=5)
+        self.assertEqual(len(x), 3)
+        self.assertTrue(x[-1] < 2.)
+        # Output points behind the current x
+        self.assertEqual(cu.stiffIntegrator(lambda t, y: -y, 0., 1.)(-1., nOut=3), None)
+
+class TestNewtSolve(unittest.TestCase):
+    def test_batch(self):
+        # Radiative equilibrium temperature for a range of absorbed fluxes
+        sigma = 5.67e-8
+        solver = cu.newtSolve(lambda T, S: sigma*T**4 - S)
+        S = np.linspace(50., 400., 1000)
+        T, converged = solver.batch(250., S)
+        self.assertTrue(converged.all())
+        self.assertTrue(np.allclose(T, (S/sigma)**0.25, rtol=1.e-10))
+        # params as a list
+        T2, converged = solver.batch(250., [100., 200.])
+        self.assertTrue(np.allclose(T2, (np.array([100., 200.])/sigma)**0.25, rtol=1.e-10))
+        # Same roots as the scalar solver
+        self.assertAlmostEqual(T[10], solver(250., S[10]), places=8)
+
+        # Arrays of guesses, with a failure from a zero derivative
+        solver = cu.newtSolve(lambda x: x*x - 2., lambda x: 2.*x)
+        x, converged = solver.batch(np.array([[1., 0.], [-3., 5.]]))
+        self.assertEqual(x.shape, (2, 2))
+        self.assertEqual(converged.tolist(), [[True, False], [True, True]])
+        self.assertTrue(np.allclose(x[converged], [math.sqrt(2.), -math.sqrt(2.), math.sqrt(2.)]))
+
+if __name__ == '__main__':
+    unittest.main()